@@ -0,0 +1,51 @@
+# End-to-end bridge throughput and latency using the loopback transport.
+# Run from the repository root: python bench/bridge_throughput.py [messages] [meshes] [mesh size]
+import sys
+import os
+import asyncio
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+import eventbus
+import loopback
+
+def build_meshes(transport, meshes, size):
+    eventbus.links.clear()
+    eventbus.reachable.clear()
+    channels = []
+    for m in range(meshes):
+        mesh = [ (transport.name, f"{m}/{i}") for i in range(size) ]
+        for a in mesh:
+            for b in mesh:
+                if a != b: eventbus.link_added(a, b)
+        channels.extend(channel for _, channel in mesh)
+    return channels
+
+async def drained():
+    while eventbus.scheduled:
+        await asyncio.sleep(0.001)
+
+async def main(messages, meshes, size):
+    # synthetic sources would otherwise be rate limited almost immediately
+    eventbus.rate_limiting = eventbus.RateLimiter(float("inf"), 1.0, 60.0)
+    transport = loopback.LoopbackTransport()
+    transport.start()
+    channels = build_meshes(transport, meshes, size)
+    dropped_before = sum(s.value for m in eventbus.evbus_deliveries_dropped.collect() for s in m.samples if s.name.endswith("_total"))
+
+    start = time.perf_counter()
+    await transport.generate(channels, messages)
+    await drained()
+    elapsed = time.perf_counter() - start
+
+    dropped = sum(s.value for m in eventbus.evbus_deliveries_dropped.collect() for s in m.samples if s.name.endswith("_total")) - dropped_before
+    print(f"{messages} messages into {meshes} meshes of {size} channels")
+    print(f"  {transport.delivered} deliveries in {elapsed:.2f}s ({transport.delivered / elapsed:.0f}/s), {dropped:.0f} dropped")
+    print(f"  latency p50 {transport.percentile(0.5) * 1e3:.2f}ms p99 {transport.percentile(0.99) * 1e3:.2f}ms")
+    transport.stop()
+
+if __name__ == "__main__":
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    meshes = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    asyncio.run(main(messages, meshes, size))
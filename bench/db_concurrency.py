@@ -0,0 +1,77 @@
+# Simulates concurrent command load (mostly user data lookups and searches, some writes with commits) against the previous
+# single aiosqlite connection and the pooled WAL database layer with group commit.
+# Run from the repository root: python bench/db_concurrency.py [operations] [concurrency] [readers]
+import sys
+import os
+import asyncio
+import random
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+import db
+
+class SingleConnection:
+    "The previous setup: everything through one connection, rollback journal, one commit per write."
+    def __init__(self, conn): self.conn = conn
+    def __getattr__(self, name): return getattr(self.conn, name)
+    def execute_fetchone(self, sql, params=None): return db.fetchone(self.conn, sql, params)
+
+async def old_init(path):
+    conn = await db.connect(path)
+    for migration in db.migrations: await conn.executescript(migration)
+    await conn.commit()
+    return SingleConnection(conn)
+
+USERS = 5000
+KEYS = [ f"key{i}" for i in range(20) ]
+
+async def seed(database):
+    await database.executemany("INSERT OR REPLACE INTO user_data VALUES (?, ?, ?, ?)", [ (u, "_global", k, "x" * 50) for u in range(USERS) for k in KEYS ])
+    await database.executemany("INSERT INTO deleted_items (timestamp, item) VALUES (?, ?)", [ (i, f"item {i} {random.random()}") for i in range(50000) ])
+    await database.commit()
+
+async def operation(database):
+    r = random.random()
+    user, key = random.randrange(USERS), random.choice(KEYS)
+    if r < 0.7:
+        await database.execute_fetchone("SELECT * FROM user_data WHERE user_id = ? AND guild_id = '_global' AND key = ?", (user, key))
+    elif r < 0.85:
+        await database.execute_fetchall("SELECT * FROM deleted_items WHERE item LIKE ? ORDER BY timestamp DESC LIMIT 100", (f"%{random.randrange(1000)}%",))
+    else:
+        await database.execute("INSERT OR REPLACE INTO user_data VALUES (?, ?, ?, ?)", (user, "_global", key, str(random.random())))
+        await database.commit()
+
+async def run(name, database, operations, concurrency):
+    await seed(database)
+    latencies = []
+    remaining = operations
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            await operation(database)
+            latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{name}: {operations / elapsed:.0f} ops/s, p50 {latencies[len(latencies) // 2] * 1e3:.2f}ms p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.2f}ms")
+    if isinstance(database, db.Database):
+        samples = { s.name: s.value for m in db.commit_batch_size.collect() for s in m.samples }
+        print(f"  {samples['abr_db_commit_batch_size_sum']:.0f} commit requests in {samples['abr_db_commit_batch_size_count']:.0f} commits")
+    await database.close()
+
+async def main(operations, concurrency, readers):
+    with tempfile.TemporaryDirectory() as tmp:
+        random.seed(0)
+        await run("single connection", await old_init(os.path.join(tmp, "old.db")), operations, concurrency)
+        random.seed(0)
+        await run(f"WAL, {readers} readers, group commit", await db.init(os.path.join(tmp, "new.db"), readers), operations, concurrency)
+
+if __name__ == "__main__":
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    readers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    asyncio.run(main(operations, concurrency, readers))
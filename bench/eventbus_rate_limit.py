@@ -0,0 +1,46 @@
+# Microbenchmark of the eventbus rate limiter against the previous namedtuple/datetime implementation.
+# Run from the repository root: python bench/eventbus_rate_limit.py [calls] [sources]
+import sys
+import os
+import collections
+import datetime
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+import eventbus
+
+RLData = collections.namedtuple("RLData", ["allowance", "last_check"])
+def timestamp_µs(): return int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp() * 1e6)
+
+def old_limiter():
+    rate, per = eventbus.RATE, eventbus.PER * 1e6
+    rate_limiting = collections.defaultdict(lambda: RLData(rate, timestamp_µs()))
+    def allow(source, cost):
+        current = timestamp_µs()
+        allowance = rate_limiting[source].allowance + (current - rate_limiting[source].last_check) * (rate / per)
+        if allowance > rate: allowance = rate
+        rate_limiting[source] = RLData(allowance, current)
+        if allowance < 1: return False
+        rate_limiting[source] = RLData(allowance - cost, current)
+        return True
+    return allow, rate_limiting
+
+def new_limiter():
+    limiter = eventbus.RateLimiter(eventbus.RATE, eventbus.PER, 60.0)
+    return limiter.allow, limiter.buckets
+
+def bench(name, make, keys):
+    allow, state = make()
+    start = time.perf_counter()
+    for key in keys: allow(key, 1.0)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {elapsed * 1e9 / len(keys):.0f}ns/call, {len(state)} entries retained")
+
+if __name__ == "__main__":
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    sources = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    random.seed(0)
+    keys = [ (("discord", random.randrange(sources)), False) for _ in range(calls) ]
+    bench("namedtuple + datetime", old_limiter, keys)
+    bench("RateLimiter", new_limiter, keys)
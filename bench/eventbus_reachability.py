@@ -0,0 +1,46 @@
+# Compares the eventbus reachability index against walking the link graph for every message.
+# Run from the repository root: python bench/eventbus_reachability.py [nodes] [lookups]
+import sys
+import os
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+import eventbus
+
+def build_graph(nodes, meshes, extra_edges):
+    eventbus.links.clear()
+    eventbus.reachable.clear()
+    channels = [ ("discord", i) for i in range(nodes) ]
+    # split into bridge meshes of varying sizes, chained bidirectionally, with some one-way links on top
+    random.shuffle(channels)
+    size = nodes // meshes
+    for start in range(0, nodes, size):
+        mesh = channels[start:start + size]
+        for a, b in zip(mesh, mesh[1:]):
+            eventbus.link_added(a, b)
+            eventbus.link_added(b, a)
+    for _ in range(extra_edges):
+        eventbus.link_added(random.choice(channels), random.choice(channels))
+    return channels
+
+def bench(name, fn, sources):
+    start = time.perf_counter()
+    for source in sources: fn(source)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {elapsed * 1e6 / len(sources):.2f}µs/lookup ({len(sources)} lookups)")
+
+if __name__ == "__main__":
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    random.seed(0)
+    for meshes in (1000, 100, 10):
+        channels = build_graph(nodes, meshes, nodes // 20)
+        sources = [ random.choice(channels) for _ in range(lookups) ]
+        print(f"{nodes} nodes, {meshes} meshes")
+        bench("  BFS", eventbus.walk_links, sources)
+        eventbus.reachable.clear()
+        bench("  index (cold)", eventbus.find_all_destinations, sources)
+        bench("  index (warm)", eventbus.find_all_destinations, sources)
+        for source in sources[:50]:
+            assert eventbus.find_all_destinations(source) == eventbus.walk_links(source)
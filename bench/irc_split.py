@@ -0,0 +1,68 @@
+# Checks properties of irc_link's UTF-8 line splitting on random multi-byte text, then benchmarks it against the previous
+# decode-and-retry approach on large inputs.
+# Run from the repository root: python bench/irc_split.py [property cases]
+import sys
+import os
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+import irc_link
+
+def bytewise_truncate(x, max):
+    x = x[:max]
+    while True:
+        try:
+            return x, x.decode("utf-8")
+        except UnicodeDecodeError:
+            x = x[:-1]
+
+def old_split(text, limit):
+    lines = []
+    content = text.encode("utf-8")
+    while content:
+        next_line, next_line_u = bytewise_truncate(content, limit)
+        lines.append(next_line_u)
+        content = content[len(next_line):]
+    return lines
+
+ALPHABETS = ["abcdefghij", "éüß", "αβγδ", "漢字仮名", "🐝🦀👁️", "  "]
+
+def random_text(length):
+    return "".join(random.choice(random.choice(ALPHABETS)) for _ in range(length))
+
+def check_properties(cases):
+    for _ in range(cases):
+        text = random_text(random.randrange(0, 2000))
+        limit = random.randrange(4, 500)
+        lines = irc_link.split_utf8(text, limit)
+        assert all(0 < len(line.encode("utf-8")) <= limit for line in lines), "line over budget or empty"
+        # lines are consecutive pieces of the input, with at most one space dropped at each break
+        # (tracking every position the lines could have reached, since runs of spaces make alignment ambiguous)
+        positions = {0}
+        for line in lines:
+            positions = { p + len(line) for p in positions if text.startswith(line, p) } | { p + 1 + len(line) for p in positions if p > 0 and text.startswith(" " + line, p) }
+            assert positions, "lines are not consecutive pieces of the input"
+        # a trailing space can be consumed by the last break
+        assert len(text) in positions or (text.endswith(" ") and len(text) - 1 in positions), "text lost"
+        truncated, cut = irc_link.truncate_utf8(text, limit)
+        assert text.startswith(truncated) and len(truncated.encode("utf-8")) <= limit and cut == (truncated != text)
+        # a truncation should not stop short of a codepoint which would fit
+        assert not cut or len(text[:len(truncated) + 1].encode("utf-8")) > limit
+    print(f"{cases} property cases passed")
+
+def bench(name, fn, texts):
+    start = time.perf_counter()
+    for text in texts: fn(text, irc_link.LINE_BUDGET)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {elapsed * 1e3 / len(texts):.3f}ms/message")
+
+if __name__ == "__main__":
+    cases = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    random.seed(0)
+    check_properties(cases)
+    for length in (2000, 20000):
+        texts = [ random_text(length) for _ in range(50) ]
+        print(f"{length} characters of mixed-width text")
+        bench("  decode-and-retry", old_split, texts)
+        bench("  split_utf8", irc_link.split_utf8, texts)
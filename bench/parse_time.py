@@ -0,0 +1,84 @@
+# Benchmarks util.parse_time on a corpus of typical remind time specs against the previous try-every-parser implementation,
+# checking that both agree first.
+# Run from the repository root: python bench/parse_time.py [iterations]
+import sys
+import os
+import re
+import math
+import random
+import datetime
+import time
+import pytz
+from dateutil.relativedelta import relativedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+import util
+
+def old_parse_prefixed(s):
+    match = re.match(util.number, s)
+    if not match: raise ValueError("does not match metric-prefixed integer format - ensure prefix is valid")
+    num = float(match.group(1))
+    prefix = match.group(2)
+    if prefix: num *= (10 ** util.prefixes[prefix])
+    return num
+
+def old_parse_short_timedelta(text):
+    match = util.short_timedelta_regex.fullmatch(text)
+    if match is None or not match.group(0): raise ValueError("parse failed")
+    data = { k: old_parse_prefixed(v) if v else 0 for k, v in match.groupdict().items() }
+    for tu, mapping in util.tu_mappings.items():
+        if callable(mapping): mapping = mapping()
+        qty, resunit = mapping
+        data[resunit] += qty * data[tu]
+        del data[tu]
+    for tu, (qty, unit) in util.fractional_tu_mappings.items():
+        if tu in data and math.floor(data[tu]) != data[tu]:
+            whole = math.floor(data[tu])
+            fractional = data[tu] - whole
+            data[tu] = whole
+            data[unit] += fractional * qty
+    return datetime.datetime.now(tz=datetime.timezone.utc) + relativedelta(**data)
+
+def old_parse_humantime(text, tz):
+    dt_tuple = util.cal.parseDT(text, tzinfo=tz)
+    if dt_tuple: return dt_tuple[0]
+    else: raise ValueError("parse failed")
+
+def old_parse_time(text, tz):
+    try: return datetime.datetime.strptime(text, "%Y-%m-%d")
+    except: pass
+    try: return old_parse_short_timedelta(text)
+    except: pass
+    try: return old_parse_humantime(text, tz)
+    except: pass
+    raise ValueError("time matches no available format")
+
+CORPUS = [
+    "5m", "10m", "30m", "1h", "2h", "1h30m", "12h", "1d", "2d", "1w", "2w", "1mo", "3mo", "6mo", "1y", "1.5y", "2.5mo",
+    "1d12h", "3d 4h", "45s", "90m", "1ks", "1Ms", "1ft", "1fn", "1semester", "2ke", "3hbs", "1kd",
+    "2024-01-01", "2025-12-25", "2030-6-1",
+    "tomorrow", "tomorrow 9am", "next week", "friday", "next monday at noon", "in 3 hours", "8pm", "noon",
+]
+# what users actually send is dominated by a few short specs
+WEIGHTS = [ 20 if i < 10 else 3 if i < 30 else 1 for i in range(len(CORPUS)) ]
+
+def close(a, b):
+    # relative specs are computed against slightly different "now"s
+    if a.tzinfo is None or b.tzinfo is None: return a == b
+    return abs((a - b).total_seconds()) < 1
+
+def bench(name, fn, specs, tz):
+    start = time.perf_counter()
+    for spec in specs: fn(spec, tz)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {elapsed * 1e6 / len(specs):.2f}µs/spec")
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    random.seed(0)
+    tz = pytz.timezone("Europe/London")
+    for spec in CORPUS:
+        assert close(old_parse_time(spec, tz), util.parse_time(spec, tz)), spec
+    specs = random.choices(CORPUS, WEIGHTS, k=iterations)
+    bench("try every parser", old_parse_time, specs, tz)
+    bench("dispatch + memoized deltas", util.parse_time, specs, tz)
@@ -0,0 +1,71 @@
+# Benchmarks the reminder scheduler on synthetic reminders: bulk load, scheduling, rescheduling/cancellation and firing due
+# batches, against the previous sorted list (bisect + list.insert, pop(0)) on a smaller load since it is quadratic.
+# Run from the repository root: python bench/reminder_scheduler.py [reminders] [sorted list reminders]
+import sys
+import os
+import random
+import bisect
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+import reminders
+
+def timed(name, fn, count):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f"  {name}: {elapsed:.3f}s ({elapsed * 1e6 / count:.2f}µs/reminder)")
+    return result
+
+def synthetic(count, now):
+    # spread over the next year, with clusters on round minutes as people tend to ask for those
+    return [ (id, now + (random.randrange(0, 365 * 86400) // 60 * 60 if random.random() < 0.5 else random.uniform(0, 365 * 86400))) for id in range(count) ]
+
+def sorted_list(entries):
+    queue = []
+    def load():
+        for id, t in entries:
+            queue.insert(bisect.bisect_left(queue, (t, id)), (t, id))
+    def drain():
+        while queue: queue.pop(0)
+    print(f"sorted list, {len(entries)} reminders")
+    timed("load", load, len(entries))
+    timed("drain", drain, len(entries))
+
+def heap(entries, now):
+    print(f"heap scheduler, {len(entries)} reminders")
+    scheduler = reminders.Scheduler()
+    timed("bulk load", lambda: scheduler.load(entries), len(entries))
+    scheduler = reminders.Scheduler()
+    def schedule():
+        for id, t in entries: scheduler.schedule(id, t)
+    timed("schedule one at a time", schedule, len(entries))
+    changed = random.sample(entries, len(entries) // 10)
+    def churn():
+        for i, (id, t) in enumerate(changed):
+            if i % 2: scheduler.cancel(id)
+            else: scheduler.schedule(id, t + 3600)
+    timed("reschedule/cancel 10%", churn, len(changed))
+    batches = 0
+    def drain():
+        nonlocal batches
+        fired = 0
+        # jump to each next due time, as the reminder loop does
+        t = now
+        while len(scheduler):
+            fired += len(scheduler.pop_due(t + reminders.BATCH_WINDOW))
+            batches += 1
+            t = scheduler.next_time()
+        return fired
+    fired = timed("fire in due batches", drain, len(entries))
+    print(f"  {fired} fired in {batches} batches")
+    assert fired == len(entries) - len(changed) // 2
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    list_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    random.seed(0)
+    now = time.time()
+    entries = synthetic(count, now)
+    heap(entries, now)
+    sorted_list(entries[:list_count])
@@ -0,0 +1,86 @@
+# Checks that the telephone Directory's in-memory state matches what a fresh Directory loads from the same DB (as after a
+# restart), across random configure (including replacing an existing address or channel), disable, add_call and remove_call.
+# Run from the repository root: python bench/telephone_directory.py [operations] [seed]
+import sys
+import os
+import asyncio
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+import db
+import telephone
+
+GUILDS = 30
+CHANNELS = 40
+
+def snapshot(directory):
+    # enabled is in arbitrary order (removal swaps in the last entry), so compare it as a set, after checking its index
+    assert len(directory.enabled) == len(directory.enabled_index), "enabled and enabled_index sizes differ"
+    for i, addr in enumerate(directory.enabled):
+        assert directory.enabled_index[addr] == i, f"enabled_index wrong for {addr}"
+    return {
+        "addresses": { k: dict(v) for k, v in directory.addresses.items() },
+        "channels": { k: dict(v) for k, v in directory.channels.items() },
+        "enabled": set(directory.enabled),
+        "calls_from": { k: dict(v) for k, v in directory.calls_from.items() },
+        "calls_to": { k: { f: dict(row) for f, row in v.items() } for k, v in directory.calls_to.items() },
+    }
+
+def in_call(directory, addr):
+    return directory.outgoing(addr) is not None or bool(directory.incoming(addr))
+
+async def step(directory, database):
+    op = random.choice(("configure", "configure", "disable", "add_call", "add_call", "remove_call"))
+    addrs = [ row["id"] for row in directory.addresses.values() ]
+    if op == "configure":
+        # guilds and channels are drawn from small pools, so this often replaces an existing address or channel
+        guild_id, channel_id = random.randrange(GUILDS), random.randrange(CHANNELS)
+        addr = telephone.generate_address(guild_id, lambda address: directory.address_taken(address, guild_id))
+        replaced = [ row for row in (directory.get_address(addr), directory.get_channel(channel_id)) if row ]
+        # calls reference the config rows, so the bot can't replace them mid-call either
+        if any(in_call(directory, row["id"]) for row in replaced): return
+        await directory.configure(addr, guild_id, channel_id, random.choice((None, f"https://example.invalid/{channel_id}")))
+    elif op == "disable" and addrs:
+        await directory.disable(random.choice(addrs))
+    elif op == "add_call" and len(addrs) > 1:
+        from_id, to_id = random.sample(addrs, 2)
+        if directory.outgoing(from_id): return
+        await directory.add_call(from_id, to_id, random.randrange(1 << 31))
+    elif op == "remove_call" and directory.calls_from:
+        call = random.choice(list(directory.calls_from.values()))
+        await directory.remove_call(call["from_id"], call["to_id"])
+    else:
+        return
+    await directory.commit()
+
+async def main(operations):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "directory.db")
+        database = await db.init(path)
+        try:
+            directory = telephone.Directory(database)
+            await directory.load()
+            for i in range(operations):
+                await step(directory, database)
+                if i % 50 == 49 or i == operations - 1:
+                    # a fresh Directory on the same DB is what the bot would have after restarting
+                    reloaded = telephone.Directory(database)
+                    await reloaded.load()
+                    assert snapshot(directory) == snapshot(reloaded), f"in-memory directory diverged from the DB after {i + 1} operations"
+        finally:
+            await database.close()
+        # and from a new connection, as after an actual restart
+        database = await db.init(path)
+        try:
+            reloaded = telephone.Directory(database)
+            await reloaded.load()
+            assert snapshot(directory) == snapshot(reloaded), "directory diverged across reopening the DB"
+        finally:
+            await database.close()
+        print(f"{operations} operations: {len(directory.addresses)} addresses ({len(directory.enabled)} enabled), {len(directory.calls_from)} calls, consistent after reload")
+
+if __name__ == "__main__":
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    random.seed(int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    asyncio.run(main(operations))
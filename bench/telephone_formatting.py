@@ -0,0 +1,80 @@
+# Benchmarks telephone mention parsing/rendering against the previous regex-search/string-concatenation implementation.
+# Run from the repository root: python bench/telephone_formatting.py [messages]
+import sys
+import os
+import re
+import random
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+import telephone
+
+def old_parse_formatting(bot, text):
+    def parse_match(m):
+        target = int(m.group(2))
+        if m.group(1) == "@":
+            user = bot.get_user(target)
+            if user: return { "type": "user_mention", "name": user.name, "id": target }
+            return f"@{target}"
+        else:
+            channel = bot.get_channel(target)
+            if channel: return { "type": "channel_mention", "name": channel.name, "id": target }
+            return f"#{target}"
+    remaining = text
+    out = []
+    while match := re.search(r"<([@#])!?([0-9]+)>", remaining):
+        start, end = match.span()
+        out.append(remaining[:start])
+        out.append(parse_match(match))
+        remaining = remaining[end:]
+    out.append(remaining)
+    return list(filter(lambda x: x != "", out))
+
+def old_render_formatting(dest_channel, message):
+    out = ""
+    for seg in message:
+        if isinstance(seg, str):
+            out += seg
+        elif seg["type"] == "user_mention":
+            member = dest_channel.guild.get_member(seg["id"])
+            if member != None: out += f"<@{member.id}>"
+            else: out += f"@{seg['name']}"
+        elif seg["type"] == "channel_mention":
+            out += f"<#{seg['id']}>"
+    return out
+
+USERS = { 100000000000000000 + i: types.SimpleNamespace(id=100000000000000000 + i, name=f"user{i}") for i in range(500) }
+CHANNELS = { 200000000000000000 + i: types.SimpleNamespace(id=200000000000000000 + i, name=f"channel{i}") for i in range(50) }
+bot = types.SimpleNamespace(get_user=USERS.get, get_channel=CHANNELS.get)
+members = { id: user for id, user in USERS.items() if id % 3 }
+dest_channel = types.SimpleNamespace(guild=types.SimpleNamespace(id=1, get_member=members.get))
+
+WORDS = "the a bees apioform bridge is down again why does this happen every time lol ok sure".split()
+
+def make_message():
+    # mostly short chatter with occasional mentions, plus some long mention-heavy messages
+    parts = []
+    length = random.choice((3, 8, 15, 40, 150))
+    mentions = random.choice((0, 0, 0, 1, 2, 5, 30 if length > 100 else 1))
+    for _ in range(length): parts.append(random.choice(WORDS))
+    for _ in range(mentions):
+        if random.random() < 0.8: mention = f"<@{random.choice(list(USERS))}>"
+        else: mention = f"<#{random.choice(list(CHANNELS))}>"
+        parts.insert(random.randrange(len(parts) + 1), mention)
+    return " ".join(parts)
+
+def bench(name, parse, render, corpus):
+    start = time.perf_counter()
+    for text in corpus: render(dest_channel, parse(bot, text))
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {elapsed * 1e6 / len(corpus):.2f}µs/message")
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(0)
+    corpus = [ make_message() for _ in range(count) ]
+    for text in corpus[:1000]:
+        assert old_render_formatting(dest_channel, old_parse_formatting(bot, text)) == telephone.render_formatting(dest_channel, telephone.parse_formatting(bot, text))
+    bench("search/slice + concatenation", old_parse_formatting, old_render_formatting, corpus)
+    bench("finditer + join + caches", telephone.parse_formatting, telephone.render_formatting, corpus)
@@ -34,7 +34,7 @@ async def achieve(bot: commands.Bot, message: discord.Message, achievement):
     if conf and conf["achievement_tracking_enabled"] == 0: return
     if not conf:
         await bot.database.execute("INSERT INTO user_config VALUES (?, NULL)", (uid,))
-        await bot.database.commit()
+        await bot.database.commit(wait=False)
     # detect if achievement already earned
     if await bot.database.execute_fetchone("SELECT 1 FROM achievements WHERE user_id = ? AND achievement = ?", (uid, achievement)):
         return
@@ -45,7 +45,7 @@ async def achieve(bot: commands.Bot, message: discord.Message, achievement):
     await channel.send(embed=e)
     metrics.achievements_achieved.inc()
     await bot.database.execute("INSERT INTO achievements VALUES (?, ?, ?)", (uid, achievement, util.timestamp()))
-    await bot.database.commit()
+    await bot.database.commit(wait=False)
     logging.info("Awarded achievement %s to %s", achievement, message.author.name)
 
 async def setup(bot):
@@ -1,5 +1,10 @@
 import aiosqlite
+import asyncio
+import contextlib
+import contextvars
 import logging
+import time
+import prometheus_client
 
 migrations = [
 """
@@ -103,33 +108,212 @@ ALTER TABLE links ADD COLUMN cause TEXT;
 """,
 """
 ALTER TABLE telephone_config ADD COLUMN disabled INTEGER;
+""",
+"""
+CREATE TABLE bridged_messages (
+    message_id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    author TEXT NOT NULL,
+    webhook INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL
+);
+CREATE INDEX bridged_messages_channel_timestamp ON bridged_messages(channel_id, timestamp);
+CREATE INDEX bridged_messages_timestamp ON bridged_messages(timestamp);
+CREATE VIRTUAL TABLE bridged_messages_fts USING fts5(content, tokenize = 'trigram');
+""",
+"""
+CREATE INDEX reminders_pending ON reminders(remind_timestamp) WHERE expired = 0;
+CREATE TABLE reminders_archive (
+    id INTEGER PRIMARY KEY,
+    remind_timestamp INTEGER NOT NULL,
+    created_timestamp INTEGER NOT NULL,
+    reminder TEXT NOT NULL,
+    expired INTEGER NOT NULL,
+    extra TEXT NOT NULL
+);
 """
 ]
 
-async def execute_fetchone(self, sql, params=None):
-    if params == None: params = ()
-    return await self._execute(self._fetchone, sql, params)
+commit_batch_size = prometheus_client.Histogram("abr_db_commit_batch_size", "Commit requests served by each group commit", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+commit_latency = prometheus_client.Histogram("abr_db_commit_latency_seconds", "Time taken by each group commit on the writer connection")
+
+# commits requested within this long of the first one are done together
+GROUP_COMMIT_WINDOW = 0.005
+
+class RolledBack(Exception):
+    "Raised by Database.commit when a rollback (by any task) discarded writes the caller made since its last commit."
+
+class Database:
+    """SQLite in WAL mode, with one writer connection and a pool of read-only connections.
+    Call shapes match aiosqlite.Connection: execute & co. go to the writer (so transactions behave as before), while
+    execute_fetchall/execute_fetchone of SELECTs use a reader, unless a transaction is open and might hold writes they should see.
+    Commits requested within GROUP_COMMIT_WINDOW of each other are grouped into one.
+    All tasks share the writer's transaction, so a rollback discards every uncommitted write, not just the caller's; commit raises RolledBack for tasks whose writes were lost."""
+    def __init__(self, writer, readers):
+        self.writer = writer
+        # a semaphore rather than a queue of connections, as its waiters are served in order, where queue getters can be overtaken
+        self.idle_readers = list(readers)
+        self.reader_count = len(readers)
+        self.reader_slots = asyncio.Semaphore(len(readers))
+        self.pending_commit = None
+        self.pending_count = 0
+        # generations of the commits requested without waiting in the current group
+        self.unwaited = []
+        # generations ended by a rollback rather than a commit
+        self.rolled_back = set()
+        # commits requested without waiting which haven't completed; reads go to the writer meanwhile, so their writes are visible to everyone at once
+        self.unsynced = 0
+        # incremented whenever the writer's transaction ends; committed is the last generation whose commit (or rollback) has completed
+        self.generation = 0
+        self.committed = -1
+        # the generation in which the current task last wrote
+        self.wrote_in = contextvars.ContextVar("wrote_in", default=None)
+
+    @property
+    def in_transaction(self): return self.writer.in_transaction
+
+    def use_reader(self, sql):
+        # a task which has written in the open transaction must read from the writer to see its own writes; others can read the last committed state
+        if not self.reader_count or self.unsynced or sql.lstrip()[:6].upper() != "SELECT": return False
+        wrote_in = self.wrote_in.get()
+        return not self.writer.in_transaction or wrote_in is None or wrote_in <= self.committed
+
+    def wrote(self):
+        self.wrote_in.set(self.generation)
+
+    @contextlib.asynccontextmanager
+    async def reader(self):
+        async with self.reader_slots:
+            conn = self.idle_readers.pop()
+            try:
+                yield conn
+            finally:
+                self.idle_readers.append(conn)
+
+    def execute(self, sql, params=None):
+        self.wrote()
+        return self.writer.execute(sql, params)
+
+    def executemany(self, sql, params):
+        self.wrote()
+        return self.writer.executemany(sql, params)
+
+    def executescript(self, script):
+        self.wrote()
+        return self.writer.executescript(script)
+
+    def execute_insert(self, sql, params=None):
+        self.wrote()
+        return self.writer.execute_insert(sql, params)
+
+    async def rollback(self):
+        generation = self.generation
+        self.generation += 1
+        self.rolled_back.add(generation)
+        await self.writer.rollback()
+        self.committed = max(self.committed, generation)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """Commit the writes made in the block, or roll back if it (or the commit) fails.
+        RolledBack is passed on without rolling back again: the caller's writes are already gone, and a rollback would discard other tasks' writes since."""
+        try:
+            yield
+            await self.commit()
+        except RolledBack:
+            raise
+        except:
+            await self.rollback()
+            raise
+
+    async def execute_fetchall(self, sql, params=None):
+        if not self.use_reader(sql): return await self.writer.execute_fetchall(sql, params)
+        async with self.reader() as conn:
+            return await conn.execute_fetchall(sql, params)
+
+    async def execute_fetchone(self, sql, params=None):
+        if not self.use_reader(sql): return await fetchone(self.writer, sql, params)
+        async with self.reader() as conn:
+            return await fetchone(conn, sql, params)
+
+    async def commit(self, wait=True):
+        """Commit the writer's transaction, along with any other commits requested in the group commit window.
+        With wait unset, return without waiting for it to be durable, for writes which could be lost in a crash without harm."""
+        wrote_in = self.wrote_in.get()
+        if wrote_in in self.rolled_back: raise RolledBack("writes discarded by a rollback before commit")
+        if self.pending_commit is None:
+            self.pending_commit = asyncio.create_task(self.group_commit())
+            self.pending_count = 0
+            self.unwaited = []
+        self.pending_count += 1
+        commit = self.pending_commit
+        if wait:
+            await asyncio.shield(commit)
+            if wrote_in in self.rolled_back: raise RolledBack("writes discarded by a rollback during group commit")
+        else:
+            self.unwaited.append(wrote_in)
+            self.unsynced += 1
+            commit.add_done_callback(self.synced)
+
+    def synced(self, commit):
+        self.unsynced -= 1
+        # failures are logged in group_commit; this marks the exception retrieved
+        if not commit.cancelled(): commit.exception()
+
+    async def group_commit(self):
+        await asyncio.sleep(GROUP_COMMIT_WINDOW)
+        # writes issued from here on need a later commit
+        self.pending_commit = None
+        generation, count, unwaited = self.generation, self.pending_count, self.unwaited
+        self.generation += 1
+        commit_batch_size.observe(count)
+        start = time.perf_counter()
+        try:
+            await self.writer.commit()
+        except Exception:
+            logging.exception("Group commit of %d requests failed", count)
+            raise
+        finally:
+            commit_latency.observe(time.perf_counter() - start)
+        self.committed = max(self.committed, generation)
+        # nobody is waiting to be told about these, so at least log them
+        lost = sum(1 for g in unwaited if g in self.rolled_back)
+        if lost: logging.error("%d commits requested without waiting lost their writes to a rollback", lost)
+
+    async def close(self):
+        if self.pending_commit: await self.pending_commit
+        for _ in range(self.reader_count):
+            await self.reader_slots.acquire()
+        for conn in self.idle_readers:
+            await conn.close()
+        await self.writer.close()
 
-def _fetchone(self, sql, params):
-    cursor = self._conn.execute(sql, params)
-    return cursor.fetchone()
+async def fetchone(conn, sql, params):
+    async with conn.execute(sql, params) as cursor:
+        return await cursor.fetchone()
 
-async def init(db_path):
-    db = await aiosqlite.connect(db_path)
-    await db.execute("PRAGMA foreign_keys = ON")
+async def connect(db_path, read_only=False):
+    conn = await aiosqlite.connect(db_path)
+    conn.row_factory = aiosqlite.Row
+    await conn.execute("PRAGMA foreign_keys = ON")
+    if read_only: await conn.execute("PRAGMA query_only = ON")
+    return conn
 
-    db.row_factory = aiosqlite.Row
-    aiosqlite.Connection._fetchone = _fetchone
-    aiosqlite.Connection.execute_fetchone = execute_fetchone
+async def init(db_path, readers=4):
+    writer = await connect(db_path)
+    # WAL lets the readers proceed while the writer is writing
+    await writer.execute("PRAGMA journal_mode = WAL")
 
-    version = (await db.execute_fetchone("PRAGMA user_version"))[0]
+    version = (await fetchone(writer, "PRAGMA user_version", None))[0]
     for i in range(version, len(migrations)):
-        await db.executescript(migrations[i])
+        await writer.executescript(migrations[i])
         # Normally interpolating like this would be a terrible idea because of SQL injection.
         # However, in this case there is not an obvious alternative (the parameter-based way apparently doesn't work)
         # and i + 1 will always be an integer anyway
-        await db.execute(f"PRAGMA user_version = {i + 1}")
-        await db.commit()
+        await writer.execute(f"PRAGMA user_version = {i + 1}")
+        await writer.commit()
         logging.info(f"Migrated DB to schema {i + 1}")
 
-    return db
\ No newline at end of file
+    # in-memory databases aren't shared between connections
+    if db_path == ":memory:": readers = 0
+    return Database(writer, [ await connect(db_path, read_only=True) for _ in range(readers) ])
@@ -1,9 +1,15 @@
+import abc
 import asyncio
 import prometheus_client
 import dataclasses
 import typing
 import collections
 import logging
+import time
+import itertools
+import os
+import sys
+import msgpack
 import discord
 
 import util
@@ -32,13 +38,13 @@ class Message:
 evbus_messages = prometheus_client.Counter("abr_evbus_messages", "Messages processed by event bus", ["source_type"])
 evbus_messages_dropped = prometheus_client.Counter("abr_evbus_messages_dropped", "Messages received by event bus but dropped by rate limits", ["source_type"])
 
-# maps each bridge destination type (discord/APIONET/etc) to the listeners for it
+# maps each bridge destination type (discord/APIONET/etc) to the listeners for it, as (listener, batched) pairs
 listeners = collections.defaultdict(set)
 
 # maintains a list of all the unidirectional links between channels - key is source, values are targets
 links = collections.defaultdict(set)
 
-def find_all_destinations(source):
+def walk_links(source):
     visited = set()
     targets = set(links[source])
     while len(targets) > 0:
@@ -47,60 +53,342 @@ def find_all_destinations(source):
         visited.add(current)
     return visited
 
-# 5 messages per 5 seconds from each input channel
+# reachability index - maps each source to the frozenset of everything reachable from it
+# entries are filled lazily and patched/invalidated by the link mutation functions below
+reachable = {}
+
+def find_all_destinations(source):
+    # unlinked channels are most of what gets asked about; don't cache them, or reachable (and affected_sources) grows without bound
+    if not links.get(source): return ()
+    try:
+        return reachable[source]
+    except KeyError:
+        destinations = reachable[source] = frozenset(walk_links(source))
+        return destinations
+
+def affected_sources(c):
+    return [ source for source, destinations in reachable.items() if source == c or c in destinations ]
+
+def link_added(c1, c2):
+    if remote: remote.send("add", c1[0], c1[1], c2[0], c2[1])
+    affected = affected_sources(c1)
+    links[c1].add(c2)
+    # anything which could reach c1 can now reach c2 and everything downstream of it
+    new = walk_links(c2)
+    new.add(c2)
+    for source in affected:
+        reachable[source] = reachable[source] | new
+
+def link_removed(c1, c2):
+    if remote: remote.send("remove", c1[0], c1[1], c2[0], c2[1])
+    # removal can't be patched cheaply, so drop affected entries and let them be recomputed on demand
+    for source in affected_sources(c1):
+        del reachable[source]
+    links[c1].remove(c2)
+
+class TokenBucket:
+    __slots__ = ("allowance", "last_check")
+
+    def __init__(self, allowance, last_check):
+        self.allowance = allowance
+        self.last_check = last_check
+
+class RateLimiter:
+    "Token bucket rate limiter keyed by arbitrary hashable values, which forgets keys once they have been idle for a while."
+    def __init__(self, rate, per, idle_timeout):
+        self.rate = rate
+        self.refill = rate / per
+        self.idle_timeout = idle_timeout
+        self.buckets = {}
+        self.last_eviction = time.monotonic()
+
+    def allow(self, key, cost=1.0):
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, now)
+        else:
+            bucket.allowance = min(self.rate, bucket.allowance + (now - bucket.last_check) * self.refill)
+            bucket.last_check = now
+        if now - self.last_eviction > self.idle_timeout: self.evict(now)
+        if bucket.allowance < 1: return False
+        bucket.allowance -= cost
+        return True
+
+    def evict(self, now):
+        # buckets idle for longer than it takes to refill are full, so dropping them changes nothing
+        self.buckets = { key: bucket for key, bucket in self.buckets.items() if now - bucket.last_check < self.idle_timeout }
+        self.last_eviction = now
+
+# 10 messages per 5 seconds from each input channel, half that for bots (which are limited separately from humans)
 RATE = 10.0
-PER = 5000000.0 # µs
+PER = 5.0 # s
 
-RLData = collections.namedtuple("RLData", ["allowance", "last_check"])
-rate_limiting = collections.defaultdict(lambda: RLData(RATE, util.timestamp()))
+rate_limiting = RateLimiter(RATE, PER, 60.0)
 
-async def push(msg: Message):
-    destinations = find_all_destinations(msg.source)
-    if len(destinations) > 0:
-        # "token bucket" rate limiting algorithm - max 10 messages per 5 seconds (half that for bots)
-        # TODO: maybe separate buckets for bot and unbot?
-        current = util.timestamp_µs()
-        time_passed = current - rate_limiting[msg.source].last_check
-        allowance = rate_limiting[msg.source].allowance
-        allowance += time_passed * (RATE / PER)
-        if allowance > RATE:
-            allowance = RATE
-        rate_limiting[msg.source] = RLData(allowance, current)
-        if allowance < 1:
-            evbus_messages_dropped.labels(msg.source[0]).inc()
-            return
-        allowance -= 2.0 if msg.author.deprioritize else 1.0
-        rate_limiting[msg.source] = RLData(allowance, current)
+def route(source, deprioritize):
+    "Find where a message from source should go - returns None if it is rate limited."
+    destinations = find_all_destinations(source)
+    if len(destinations) == 0: return ()
+    if not rate_limiting.allow((source, deprioritize), 2.0 if deprioritize else 1.0): return None
+    return [ dest for dest in destinations if dest != source ]
 
+def dispatch(msg: Message, destinations):
+    if destinations is None:
+        evbus_messages_dropped.labels(msg.source[0]).inc()
+        return
+    if len(destinations) > 0:
         evbus_messages.labels(msg.source[0]).inc()
         for dest in destinations:
-            if dest == msg.source: continue
-            dest_type, dest_channel = dest
-            for listener in listeners[dest_type]:
-                asyncio.ensure_future(listener(dest_channel, msg))
+            enqueue(dest, msg)
+
+class RecentCache:
+    "Maps keys to values for at most window seconds, holding at most max_size entries (oldest are evicted first)."
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+    def expire(self, now):
+        while self.entries:
+            oldest_time, _ = next(iter(self.entries.values()))
+            if now - oldest_time < self.window and len(self.entries) < self.max_size: break
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        now = time.monotonic()
+        self.expire(now)
+        entry = self.entries.get(key)
+        return entry and entry[1]
+
+    def put(self, key, value=True):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+
+DEDUP_WINDOW = 30.0 # s
+seen_ids = RecentCache(DEDUP_WINDOW, 10000)
+# (author name, content hash) -> source it was first seen from
+seen_content = RecentCache(DEDUP_WINDOW, 10000)
+
+def is_duplicate(msg: Message):
+    id_key = (msg.source, msg.id)
+    if seen_ids.get(id_key): return True
+    seen_ids.put(id_key)
+    # the same content from the same author arriving from somewhere the original was bridged to is an echo/loop
+    # (arriving from the same place again is just someone repeating themselves)
+    content_key = (msg.author.name, hash(repr(msg.message)), tuple(at.filename for at in msg.attachments))
+    origin = seen_content.get(content_key)
+    if origin is not None and origin != msg.source and msg.source in find_all_destinations(origin): return True
+    seen_content.put(content_key, msg.source)
+    return False
+
+evbus_messages_deduplicated = prometheus_client.Counter("abr_evbus_messages_deduplicated", "Messages received by event bus but dropped as duplicates or loops", ["source_type"])
+
+async def push(msg: Message):
+    if is_duplicate(msg):
+        evbus_messages_deduplicated.labels(msg.source[0]).inc()
+        return
+    if remote:
+        await remote.route(msg)
+    else:
+        dispatch(msg, route(msg.source, msg.author.deprioritize))
 
-def add_listener(s, l):
-    listeners[s].add(l)
-    return lambda: listeners[s].remove(l)
+# routing can optionally run in a separate process (eventbus_worker.py), reached over a Unix socket with msgpack framing
+# the message itself stays here - only the source is sent over, and the worker replies with destinations
+remote = None
+
+class RemoteRouter:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.seq = itertools.count()
+        self.task = asyncio.create_task(self.read_responses())
+
+    def send(self, *op):
+        self.writer.write(msgpack.packb(op))
+
+    async def route(self, msg: Message):
+        seq = next(self.seq)
+        self.pending[seq] = msg
+        self.send("route", seq, msg.source[0], msg.source[1], msg.author.deprioritize)
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            # the worker died; read_responses will notice and reroute whatever else is pending, but this one is ours to handle
+            if self.pending.pop(seq, None) is not None:
+                dispatch(msg, route(msg.source, msg.author.deprioritize))
+
+    async def read_responses(self):
+        global remote
+        unpacker = msgpack.Unpacker()
+        try:
+            while data := await self.reader.read(65536):
+                unpacker.feed(data)
+                for op, seq, *rest in unpacker:
+                    msg = self.pending.pop(seq)
+                    if op == "local": dispatch(msg, route(msg.source, msg.author.deprioritize)) # the worker failed to route it
+                    else: dispatch(msg, None if op == "drop" else [ tuple(dest) for dest in rest[0] ])
+        except Exception:
+            logging.exception("Event bus worker connection failed")
+        # fall back to routing in-process rather than losing messages
+        logging.error("Lost event bus worker, routing locally")
+        remote = None
+        self.writer.close()
+        for msg in self.pending.values():
+            dispatch(msg, route(msg.source, msg.author.deprioritize))
+        self.pending.clear()
+
+async def start_remote(path, spawn=True):
+    global remote
+    if spawn:
+        await asyncio.create_subprocess_exec(sys.executable, os.path.join(os.path.dirname(__file__), "eventbus_worker.py"), path, "--exit-on-disconnect")
+    for _ in range(100):
+        try:
+            reader, writer = await asyncio.open_unix_connection(path)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            await asyncio.sleep(0.1)
+    else:
+        raise ConnectionError(f"event bus worker at {path} unavailable")
+    remote = RemoteRouter(reader, writer)
+    remote.send("links", [ (c1[0], c1[1], c2[0], c2[1]) for c1, targets in links.items() for c2 in targets ])
+    logging.info("Routing via event bus worker at %s", path)
+
+# per-destination delivery queues, serviced by a fixed pool of workers
+# a destination is only ever handled by one worker at a time, so delivery order is preserved for each destination
+DELIVERY_WORKERS = 16
+MAX_BATCH = 20
+MAX_QUEUED = 500
+
+delivery_queues = collections.defaultdict(collections.deque)
+# destinations with messages queued which are waiting for or being handled by a worker
+scheduled = set()
+ready = None
+delivery_workers = []
+
+evbus_queue_depth = prometheus_client.Gauge("abr_evbus_queue_depth", "Messages waiting in event bus delivery queues")
+evbus_queue_depth.set_function(lambda: sum(map(len, delivery_queues.values())))
+evbus_delivery_latency = prometheus_client.Histogram("abr_evbus_delivery_latency", "Time between messages entering the event bus and being delivered by listeners", ["dest_type"])
+evbus_deliveries_dropped = prometheus_client.Counter("abr_evbus_deliveries_dropped", "Messages dropped due to full delivery queues", ["dest_type"])
+
+def enqueue(dest, msg):
+    global ready
+    if ready is None:
+        ready = asyncio.Queue()
+        for _ in range(DELIVERY_WORKERS): delivery_workers.append(asyncio.create_task(delivery_worker()))
+    queue = delivery_queues[dest]
+    if len(queue) >= MAX_QUEUED:
+        evbus_deliveries_dropped.labels(dest[0]).inc()
+        return
+    queue.append((time.monotonic(), msg))
+    if dest not in scheduled:
+        scheduled.add(dest)
+        ready.put_nowait(dest)
+
+async def deliver(dest, batch):
+    dest_type, dest_channel = dest
+    msgs = [ msg for _, msg in batch ]
+    for listener, batched in list(listeners[dest_type]):
+        # listeners registered as batched get every queued message for the destination at once and may coalesce them
+        calls = [ listener(dest_channel, msgs) ] if batched else ( listener(dest_channel, msg) for msg in msgs )
+        for call in calls:
+            try:
+                await call
+            except Exception:
+                logging.exception("Delivery to %s failed", repr(dest))
+    now = time.monotonic()
+    for queued_at, _ in batch:
+        evbus_delivery_latency.labels(dest_type).observe(now - queued_at)
+
+async def delivery_worker():
+    while True:
+        dest = await ready.get()
+        queue = delivery_queues[dest]
+        batch = [ queue.popleft() for _ in range(min(len(queue), MAX_BATCH)) ]
+        try:
+            await deliver(dest, batch)
+        finally:
+            if queue:
+                ready.put_nowait(dest)
+            else:
+                scheduled.discard(dest)
+                del delivery_queues[dest]
+
+def add_listener(s, l, batched=False):
+    listeners[s].add((l, batched))
+    return lambda: listeners[s].remove((l, batched))
+
+# registered transports by destination type
+transports = {}
+
+class Transport(abc.ABC):
+    """A bridge backend which owns one destination type: the event bus calls send for messages bound for its channels, and it feeds messages from them in with receive.
+    Set batched to receive lists of messages per channel rather than single ones."""
+    batched = False
+
+    def __init__(self, name):
+        self.name = name
+        self.unlisten = None
+
+    @abc.abstractmethod
+    async def send(self, channel, msg):
+        "Deliver msg (or a list of them, if batched) to channel."
+
+    async def receive(self, msg: Message):
+        await push(msg)
+
+    def start(self):
+        if self.name in transports: raise ValueError(f"transport {self.name} already registered")
+        transports[self.name] = self
+        self.unlisten = add_listener(self.name, self.send, self.batched)
+
+    def stop(self):
+        if self.unlisten:
+            self.unlisten()
+            self.unlisten = None
+            del transports[self.name]
+
+# below this many changes, the reachability index is patched per link; above, it is cheaper to rebuild it lazily
+INCREMENTAL_LINK_CHANGES = 8
+
+def update_links(added=(), removed=()):
+    "Apply link changes to the in-memory graph. This doesn't yield, so other coroutines never see a partial update."
+    if len(added) + len(removed) <= INCREMENTAL_LINK_CHANGES:
+        for c1, c2 in removed:
+            if c2 in links[c1]: link_removed(c1, c2)
+        for c1, c2 in added:
+            if c2 not in links[c1]: link_added(c1, c2)
+    else:
+        for c1, c2 in removed: links[c1].discard(c2)
+        for c1, c2 in added: links[c1].add(c2)
+        reachable.clear()
+        if remote: remote.send("links", [ (c1[0], c1[1], c2[0], c2[1]) for c1, targets in links.items() for c2 in targets ])
+
+async def apply_link_changes(db, added=(), removed=()):
+    """Add and remove many (unidirectional) links in one transaction. added contains (from, to, cause) tuples and removed (from, to) pairs.
+    The in-memory graph is only updated once the transaction has committed."""
+    added, removed = list(added), list(removed)
+    now = util.timestamp()
+    async with db.transaction():
+        await db.executemany("DELETE FROM links WHERE from_type = ? AND from_id = ? AND to_type = ? AND to_id = ?", [ (c1[0], c1[1], c2[0], c2[1]) for c1, c2 in removed ])
+        await db.executemany("INSERT INTO links VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING", [ (c2[0], c2[1], c1[0], c1[1], now, cause) for c1, c2, cause in added ])
+    update_links([ (c1, c2) for c1, c2, _ in added ], removed)
 
 async def add_bridge_link(db, c1, c2, cause=None, bidirectional=True):
     logging.info("Bridging %s and %s (bidirectional: %s)", repr(c1), repr(c2), bidirectional)
-    links[c1].add(c2)
-    if bidirectional: links[c2].add(c1)
-    await db.execute("INSERT INTO links VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING", (c1[0], c1[1], c2[0], c2[1], util.timestamp(), cause))
-    if bidirectional: await db.execute("INSERT INTO links VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING", (c2[0], c2[1], c1[0], c1[1], util.timestamp(), cause))
-    await db.commit()
+    await apply_link_changes(db, added=[ (c1, c2, cause), (c2, c1, cause) ] if bidirectional else [ (c1, c2, cause) ])
 
 async def remove_bridge_link(db, c1, c2, bidirectional=True):
     logging.info("Unbridging %s and %s (bidirectional: %s)", repr(c1), repr(c2), bidirectional)
-    links[c1].remove(c2)
-    if bidirectional: links[c2].remove(c1)
-    await db.execute("DELETE FROM links WHERE (to_type = ? AND to_id = ?) AND (from_type = ? AND from_id = ?)", (c1[0], c1[1], c2[0], c2[1]))
-    if bidirectional: await db.execute("DELETE FROM links WHERE (to_type = ? AND to_id = ?) AND (from_type = ? AND from_id = ?)", (c2[0], c2[1], c1[0], c1[1]))
-    await db.commit()
+    await apply_link_changes(db, removed=[ (c1, c2), (c2, c1) ] if bidirectional else [ (c1, c2) ])
+
+async def export_links(db):
+    return [ dict(row) for row in await db.execute_fetchall("SELECT * FROM links") ]
 
 async def initial_load(db):
     rows = await db.execute_fetchall("SELECT * FROM links")
-    for row in rows:
-        links[(row["from_type"], row["from_id"])].add((row["to_type"], row["to_id"]))
-    logging.info("Loaded %d links", len(rows))
\ No newline at end of file
+    links.clear()
+    reachable.clear()
+    update_links([ ((row["from_type"], row["from_id"]), (row["to_type"], row["to_id"])) for row in rows ])
+    logging.info("Loaded %d links", len(rows))
@@ -0,0 +1,57 @@
+# Event bus routing worker: holds a copy of the link graph and the rate limits, and answers routing requests from the bot process over a Unix socket.
+# Started by eventbus.start_remote, or run manually: python eventbus_worker.py /path/to/socket
+import asyncio
+import logging
+import os
+import sys
+import msgpack
+
+import eventbus
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s %(asctime)s [evbus worker] %(message)s", datefmt="%H:%M:%S %d/%m/%Y")
+
+def apply(writer, op, args):
+    if op == "route":
+        seq, source_type, source_id, deprioritize = args
+        destinations = eventbus.route((source_type, source_id), deprioritize)
+        writer.write(msgpack.packb(("drop", seq) if destinations is None else ("route", seq, destinations)))
+    elif op == "add":
+        eventbus.link_added((args[0], args[1]), (args[2], args[3]))
+    elif op == "remove":
+        eventbus.link_removed((args[0], args[1]), (args[2], args[3]))
+    elif op == "links":
+        eventbus.links.clear()
+        eventbus.reachable.clear()
+        for from_type, from_id, to_type, to_id in args[0]:
+            eventbus.links[(from_type, from_id)].add((to_type, to_id))
+        logging.info("Loaded %d links", len(args[0]))
+    else:
+        logging.warning("Unknown operation %s", op)
+
+async def main(path, exit_on_disconnect):
+    done = asyncio.Event()
+    async def handle(reader, writer):
+        unpacker = msgpack.Unpacker()
+        while data := await reader.read(65536):
+            unpacker.feed(data)
+            for op, *args in unpacker:
+                try:
+                    apply(writer, op, args)
+                except Exception:
+                    logging.exception("Failed to apply %s", op)
+                    # the bot is waiting on a reply for this message, so have it route the message itself
+                    if op == "route": writer.write(msgpack.packb(("local", args[0])))
+            await writer.drain()
+        writer.close()
+        logging.info("Client disconnected")
+        if exit_on_disconnect: done.set()
+
+    if os.path.exists(path): os.unlink(path)
+    server = await asyncio.start_unix_server(handle, path)
+    logging.info("Listening on %s", path)
+    async with server:
+        await done.wait()
+    os.unlink(path)
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1], "--exit-on-disconnect" in sys.argv))
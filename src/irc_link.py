@@ -5,6 +5,9 @@ import random
 import util
 import logging
 import hashlib
+import time
+import collections
+import prometheus_client
 import discord.ext.commands as commands
 from jaraco.stream import buffer
 
@@ -15,109 +18,285 @@ def scramble(text):
 
 def color_code(x):
     return f"\x03{x}"
-def random_color(id): return color_code(hashlib.blake2b(str(id).encode("utf-8")).digest()[0] % 13 + 2)
+# the 13 colors which read acceptably on both light and dark backgrounds, precomputed
+COLORS = tuple(color_code(i + 2) for i in range(13))
+RESET = color_code("")
+color_cache = util.LRUCache(4096)
+def random_color(id):
+    color = color_cache.get(id)
+    if color is None:
+        color = color_cache[id] = COLORS[hashlib.blake2b(str(id).encode("utf-8")).digest()[0] % 13]
+    return color
 
 def render_formatting(message):
-    out = ""
+    out = []
     for seg in message:
         if isinstance(seg, str):
-            out += seg.replace("\n", " ")
+            out.append(seg.replace("\n", " "))
         else:
             kind = seg["type"]
             #  TODO: check if user exists on both ends, and possibly drop if so
             if kind == "user_mention":
-                out += f"@{random_color(seg['id'])}{seg['name']}{color_code('')}"
+                out.append(f"@{random_color(seg['id'])}{seg['name']}{RESET}")
             elif kind == "channel_mention": # these appear to be clickable across servers/guilds
-                out += f"#{seg['name']}"
+                out.append(f"#{seg['name']}")
             else: logging.warn("Unrecognized message seg %s", kind)
-    return out.strip()
+    return "".join(out).strip()
 
-global_conn = None
-unlisten = None
+irc_queue_depth = prometheus_client.Gauge("abr_irc_queue_depth", "Lines waiting to be sent to IRC", ["network"])
+irc_lines_dropped = prometheus_client.Counter("abr_irc_lines_dropped", "Lines dropped because the IRC output queue was full (or the network was disconnected)", ["network"])
+irc_lines_merged = prometheus_client.Counter("abr_irc_lines_merged", "Lines merged into the previous queued line by the same author", ["network"])
+irc_connected = prometheus_client.Gauge("abr_irc_connected", "Whether the IRC network connection is up and registered", ["network"])
+irc_reconnects = prometheus_client.Counter("abr_irc_reconnects", "IRC connection attempts after the first", ["network"])
+irc_relay_cpu = prometheus_client.Histogram("abr_irc_relay_cpu_seconds", "CPU time spent rendering and queueing each message relayed to IRC", ["network"], buckets=(1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2))
+irc_messages_received = prometheus_client.Counter("abr_irc_messages_received", "Channel messages received from IRC", ["network"])
 
-async def initialize():
-    logging.info("Initializing IRC link")
+def utf8_boundary(buf, pos):
+    "Move pos back to the start of the codepoint it is in (continuation bytes are 0b10xxxxxx)."
+    while 0 < pos < len(buf) and buf[pos] & 0xC0 == 0x80:
+        pos -= 1
+    return pos
 
-    joined = set()
+def truncate_utf8(text, limit):
+    "Cut text to at most limit bytes of UTF-8 without splitting a codepoint. Returns the result and whether anything was cut."
+    buf = text.encode("utf-8")
+    if len(buf) <= limit: return text, False
+    return str(memoryview(buf)[:utf8_boundary(buf, limit)], "utf-8"), True
 
-    loop = asyncio.get_event_loop()
-    irc.client.ServerConnection.buffer_class = buffer.LenientDecodingLineBuffer # should not crash in the face of invalid UTF-8
-    reactor = irc.client_aio.AioReactor(loop=loop)
-    conn = await reactor.server().connect(util.config["irc"]["server"], util.config["irc"]["port"], util.config["irc"]["nick"])
-    global global_conn
-    global_conn = conn
+def split_utf8(text, limit):
+    """Break text into lines of at most limit bytes of UTF-8, in one pass over the encoded buffer.
+    Lines are broken at the last space if there is one in the second half of the line (the space is dropped), or else at the last codepoint boundary."""
+    if limit < 4: raise ValueError("limit must fit a codepoint")
+    buf = text.encode("utf-8")
+    view = memoryview(buf)
+    out = []
+    start = 0
+    while len(buf) - start > limit:
+        end = utf8_boundary(buf, start + limit)
+        space = buf.rfind(b" ", start + limit // 2, end + 1)
+        if space != -1:
+            out.append(str(view[start:space], "utf-8"))
+            start = space + 1
+        else:
+            out.append(str(view[start:end], "utf-8"))
+            start = end
+    if start < len(buf): out.append(str(view[start:], "utf-8"))
+    return out
 
-    def inuse(conn, event):
-        conn.nick(scramble(conn.get_nickname()))
+# max bytes of message content per line
+LINE_BUDGET = 400
+
+class OutputQueue:
+    "Paces messages to stay under server flood limits: one token bucket for the connection, with per-channel queues served round-robin."
+    def __init__(self, network, conn, rate, burst, max_queued):
+        self.network = network
+        self.conn = conn
+        self.rate = rate
+        self.burst = burst
+        self.max_queued = max_queued
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        # channel -> deque of [author, content]; author is None for lines which are already fully rendered
+        self.queues = collections.OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def depth(self): return sum(map(len, self.queues.values()))
+
+    def put(self, channel, author, content):
+        queue = self.queues.setdefault(channel, collections.deque())
+        # merge short consecutive lines from the same author while they are waiting to be sent
+        if author is not None and queue and queue[-1][0] == author and len(queue[-1][1].encode("utf-8")) + len(content.encode("utf-8")) + 3 <= LINE_BUDGET:
+            queue[-1][1] += " | " + content
+            irc_lines_merged.labels(self.network).inc()
+            return
+        if len(queue) >= self.max_queued:
+            irc_lines_dropped.labels(self.network).inc()
+            return
+        queue.append([author, content])
+        self.wakeup.set()
 
-    def pubmsg(conn, event):
-        msg = eventbus.Message(eventbus.AuthorInfo(event.source.nick, str(event.source), None), [" ".join(event.arguments)], (util.config["irc"]["name"], event.target), util.random_id(), [])
-        asyncio.create_task(eventbus.push(msg))
+    async def take_token(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.tokens = 1
+            self.last_refill = time.monotonic()
+        self.tokens -= 1
 
-    def bytewise_truncate(x, max):
-        x = x[:max]
+    async def run(self):
         while True:
+            if not self.queues:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            await self.take_token()
+            channel, queue = next(iter(self.queues.items()))
+            author, content = queue.popleft()
+            # move this channel to the back so busy channels don't starve the others
+            del self.queues[channel]
+            if queue: self.queues[channel] = queue
             try:
-                return x, x.decode("utf-8")
-            except UnicodeDecodeError:
-                x = x[:-1]
+                self.conn.privmsg(channel, content if author is None else render_line(author, content))
+            except Exception:
+                logging.exception("IRC send to %s failed", channel)
 
-    def render_line(author, content):
+    def stop(self):
+        self.task.cancel()
+
+prefix_cache = util.LRUCache(4096)
+def render_prefix(author):
+    key = (author.id, author.name)
+    prefix = prefix_cache.get(key)
+    if prefix is None:
         # colorize for aesthetics
         # add ZWS to prevent pinging
-        return f"<{random_color(author.id)}{author.name[0]}\u200B{author.name[1:]}{color_code('')}> {content}"
-
-    async def on_bridge_message(channel_name, msg):
-        if channel_name in util.config["irc"]["channels"]:
-            if channel_name not in joined: conn.join(channel_name)
-            if msg.reply:
-                if msg.reply[0] and msg.reply[1]:
-                    reply_line = render_line(msg.reply[0], render_formatting(msg.reply[1])).encode("utf-8")
-                    reply_line_new, reply_line_u = bytewise_truncate(reply_line, 300)
-                    if reply_line_new != reply_line:
-                        reply_line_u += " ..."
-                    conn.privmsg(channel_name, f"[Replying to {reply_line_u}]")
-                else:
-                    conn.privmsg(channel_name, "[Replying to an unknown message]")
-            lines = []
-            content = render_formatting(msg.message).encode("utf-8")
-            # somewhat accursedly break string into valid UTF-8 substrings with <=400 bytes
-            while content:
-                next_line, next_line_u = bytewise_truncate(content, 400)
-                lines.append(next_line_u)
-                content = content[len(next_line):]
-            for line in lines:
-                conn.privmsg(channel_name, render_line(msg.author, line))
-            for at in msg.attachments:
-                conn.privmsg(channel_name, render_line(msg.author, f"-> {at.filename}: {at.proxy_url}"))
+        prefix = prefix_cache[key] = f"<{random_color(author.id)}{author.name[0]}\u200B{author.name[1:]}{RESET}> "
+    return prefix
+
+def render_line(author, content):
+    return render_prefix(author) + content
+
+def render_message(msg):
+    "Render a bridged message into (author, line) pairs for OutputQueue.put: the reply header (already fully rendered, so author None), then body and attachment lines."
+    lines = []
+    if msg.reply:
+        if msg.reply[0] and msg.reply[1]:
+            reply_line, truncated = truncate_utf8(render_line(msg.reply[0], render_formatting(msg.reply[1])), 300)
+            lines.append((None, f"[Replying to {reply_line} ...]" if truncated else f"[Replying to {reply_line}]"))
         else:
-            logging.warning("IRC channel %s not allowed", channel_name)
+            lines.append((None, "[Replying to an unknown message]"))
+    for line in split_utf8(render_formatting(msg.message), LINE_BUDGET):
+        lines.append((msg.author, line))
+    for at in msg.attachments:
+        lines.append((msg.author, f"-> {at.filename}: {at.proxy_url}"))
+    return lines
 
-    def connect(conn, event):
-        for channel in util.config["irc"]["channels"]:
-            conn.join(channel, key=util.config["irc"]["channel_keys"].get(channel, ""))
-            logging.info("Connected to %s on IRC", channel)
-            joined.add(channel)
+MAX_BACKOFF = 300 # s
+# IRC lines are limited to 512 bytes including command and CRLF
+JOIN_BUDGET = 400
 
-    def disconnect(conn, event):
-        logging.warn("Disconnected from IRC, reinitializing")
-        teardown()
-        if not conn.planned_disconnection: asyncio.create_task(initialize())
+def join_commands(channels, keys):
+    "Pack channel joins into as few JOIN commands as fit (channels with keys go first, as keys are matched by position)."
+    keyed = sorted(channels, key=lambda channel: not keys.get(channel))
+    joins, current, current_keys, size = [], [], [], 0
+    for channel in keyed:
+        key = keys.get(channel, "")
+        if current and size + len(channel) + len(key) + 2 > JOIN_BUDGET:
+            joins.append((current, current_keys))
+            current, current_keys, size = [], [], 0
+        current.append(channel)
+        if key: current_keys.append(key)
+        size += len(channel) + len(key) + 2
+    if current: joins.append((current, current_keys))
+    return [ f"JOIN {','.join(chans)} {','.join(chan_keys)}".strip() for chans, chan_keys in joins ]
 
-    # TODO: do better thing
-    conn.add_global_handler("welcome", connect)
-    conn.add_global_handler("disconnect", disconnect)
-    conn.add_global_handler("nicknameinuse", inuse)
-    conn.add_global_handler("pubmsg", pubmsg)
+class Network(eventbus.Transport):
+    "One IRC network, bridged as its own event bus destination type (its configured name)."
+    def __init__(self, config):
+        super().__init__(config["name"])
+        self.config = config
+        self.conn = None
+        self.output = None
+        self.joined = set()
+        self.backoff = 1
+        self.stopping = False
+        self.connect_task = None
+        self.reactor = irc.client_aio.AioReactor(loop=asyncio.get_running_loop())
+        self.reactor.add_global_handler("welcome", self.on_welcome)
+        self.reactor.add_global_handler("disconnect", self.on_disconnect)
+        self.reactor.add_global_handler("nicknameinuse", self.on_nick_in_use)
+        self.reactor.add_global_handler("pubmsg", self.on_pubmsg)
+        irc_queue_depth.labels(self.name).set_function(lambda: self.output.depth() if self.output else 0)
 
-    global unlisten
-    unlisten = eventbus.add_listener(util.config["irc"]["name"], on_bridge_message)
+    def start(self):
+        super().start()
+        self.connect_task = asyncio.create_task(self.connect())
+
+    def stop(self):
+        self.stopping = True
+        if self.connect_task: self.connect_task.cancel()
+        if self.output: self.output.stop()
+        if self.conn: self.conn.disconnect()
+        super().stop()
+
+    async def connect(self, delay=0):
+        # exponential backoff between attempts, reset once the server welcomes us
+        await asyncio.sleep(delay)
+        while not self.stopping:
+            logging.info("Connecting to IRC network %s", self.name)
+            try:
+                self.conn = await self.reactor.server().connect(self.config["server"], self.config["port"], self.config["nick"])
+            except (irc.client.ServerConnectionError, OSError) as e:
+                logging.warning("Could not connect to IRC network %s (%s), retrying in %ds", self.name, e, self.backoff)
+                irc_reconnects.labels(self.name).inc()
+                await asyncio.sleep(self.backoff)
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+                continue
+            if self.output: self.output.stop()
+            self.output = OutputQueue(self.name, self.conn, self.config.get("lines_per_second", 1.0), self.config.get("burst", 5), self.config.get("max_queued", 100))
+            return
+
+    def on_welcome(self, conn, event):
+        self.backoff = 1
+        irc_connected.labels(self.name).set(1)
+        # send all joins straight away, packed into as few commands as possible, rather than one at a time
+        channels = self.config["channels"]
+        for command in join_commands(channels, self.config.get("channel_keys", {})):
+            conn.send_raw(command)
+        self.joined.update(channels)
+        logging.info("Connected to %s on IRC network %s", ", ".join(channels), self.name)
+
+    def on_disconnect(self, conn, event):
+        irc_connected.labels(self.name).set(0)
+        self.joined.clear()
+        if self.stopping: return
+        logging.warning("Disconnected from IRC network %s, reconnecting in %ds", self.name, self.backoff)
+        irc_reconnects.labels(self.name).inc()
+        delay = self.backoff
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+        self.connect_task = asyncio.create_task(self.connect(delay))
+
+    def on_nick_in_use(self, conn, event):
+        conn.nick(scramble(conn.get_nickname()))
+
+    def on_pubmsg(self, conn, event):
+        irc_messages_received.labels(self.name).inc()
+        msg = eventbus.Message(eventbus.AuthorInfo(event.source.nick, str(event.source), None), [" ".join(event.arguments)], (self.name, event.target), util.random_id(), [])
+        asyncio.create_task(self.receive(msg))
+
+    async def send(self, channel_name, msg):
+        if channel_name not in self.config["channels"]:
+            logging.warning("IRC channel %s not allowed on %s", channel_name, self.name)
+            return
+        if not self.output or not self.conn.is_connected():
+            irc_lines_dropped.labels(self.name).inc()
+            return
+        if channel_name not in self.joined:
+            self.conn.join(channel_name, key=self.config.get("channel_keys", {}).get(channel_name, ""))
+            self.joined.add(channel_name)
+        start = time.thread_time()
+        for author, line in render_message(msg):
+            self.output.put(channel_name, author, line)
+        irc_relay_cpu.labels(self.name).observe(time.thread_time() - start)
+
+def network_configs():
+    # either a single [irc] table or several [[irc]] tables
+    irc_config = util.config.get("irc", [])
+    return irc_config if isinstance(irc_config, list) else [irc_config]
+
+networks = {}
 
 async def setup(bot):
-    asyncio.create_task(initialize())
+    irc.client.ServerConnection.buffer_class = buffer.LenientDecodingLineBuffer # should not crash in the face of invalid UTF-8
+    for config in network_configs():
+        network = Network(config)
+        network.start()
+        networks[network.name] = network
 
 async def teardown(bot=None):
-    if global_conn:
-        global_conn.planned_disconnection = True
-        global_conn.disconnect()
-    if unlisten: unlisten()
+    for network in networks.values():
+        network.stop()
+    networks.clear()
@@ -0,0 +1,52 @@
+import asyncio
+import time
+import itertools
+import random
+
+import eventbus
+
+# low bits of message ids hold a sequence number, the rest the send time (monotonic ns), so nothing need be kept per message
+SEQ_BITS = 20
+# latencies kept (a uniform sample of all deliveries) for percentiles
+LATENCY_SAMPLE = 10000
+
+class LoopbackTransport(eventbus.Transport):
+    "In-process transport which generates synthetic messages and sinks delivered ones, for load testing the event bus without real services."
+    batched = True
+
+    def __init__(self, name="loopback"):
+        super().__init__(name)
+        self.ids = itertools.count()
+        self.delivered = 0
+        self.latencies = []
+
+    def reset(self):
+        self.delivered = 0
+        self.latencies = []
+
+    def make_message(self, channel, author_id, text):
+        id = time.monotonic_ns() << SEQ_BITS | next(self.ids) & ((1 << SEQ_BITS) - 1)
+        return eventbus.Message(eventbus.AuthorInfo(f"user{author_id}", author_id), [text], (self.name, channel), id, [])
+
+    async def generate(self, channels, count, authors=16, yield_every=64):
+        "Push count messages from the given channels in turn, yielding to the event loop periodically so delivery can keep up."
+        for i in range(count):
+            await self.receive(self.make_message(channels[i % len(channels)], i % authors, f"message {i}"))
+            if i % yield_every == 0: await asyncio.sleep(0)
+
+    async def send(self, channel, msgs):
+        now = time.monotonic_ns()
+        for msg in msgs:
+            self.delivered += 1
+            latency = (now - (msg.id >> SEQ_BITS)) / 1e9
+            # reservoir sampling, so memory use doesn't grow with the number of messages
+            if len(self.latencies) < LATENCY_SAMPLE:
+                self.latencies.append(latency)
+            else:
+                i = random.randrange(self.delivered)
+                if i < LATENCY_SAMPLE: self.latencies[i] = latency
+
+    def percentile(self, p):
+        if not self.latencies: return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
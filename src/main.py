@@ -104,8 +104,10 @@ def get_guild_count():
 guild_count.set_function(get_guild_count)
 
 async def run_bot():
-    bot.database = await db.init(config["database"])
+    bot.database = await db.init(config["database"], config.get("database_readers", 4))
     await eventbus.initial_load(bot.database)
+    if "evbus_worker" in config:
+        await eventbus.start_remote(config["evbus_worker"]["socket"], config["evbus_worker"].get("spawn", True))
     for ext in util.extensions:
         logging.info("Loaded %s", ext)
         await bot.load_extension(ext)
@@ -2,4 +2,6 @@ import prometheus_client
 
 achievements_achieved = prometheus_client.Counter("abr_achievements", "Achievements achieved by users")
 reminders_fired = prometheus_client.Counter("abr_reminders", "Reminders successfully delivered to users")
+reminders_archived = prometheus_client.Counter("abr_reminders_archived", "Expired reminders moved to the archive table")
+reminders_startup = prometheus_client.Gauge("abr_reminders_startup_seconds", "Time taken to load and schedule pending reminders at startup")
 role_transfers = prometheus_client.Counter("abr_role_transfers", "Times the esoserver transferable role has been transferred")
\ No newline at end of file
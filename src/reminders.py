@@ -4,54 +4,135 @@ from datetime import datetime, timezone
 import discord.ext.tasks as tasks
 from discord.ext import commands
 import asyncio
+import heapq
+import collections
+import time
+import io
+import discord
 
 import util
 import metrics
+import db
 
-# https://github.com/python/cpython/blob/3.10/Lib/bisect.py (we need the 3.10 version)
-def bisect_left(a, x, lo=0, hi=None, *, key=None):
-    """Return the index where to insert item x in list a, assuming a is sorted.
-    The return value i is such that all e in a[:i] have e < x, and all e in
-    a[i:] have e >= x.  So if x already appears in the list, a.insert(i, x) will
-    insert just before the leftmost x already there.
-    Optional args lo (default 0) and hi (default len(a)) bound the
-    slice of a to be searched.
-    """
-
-    if lo < 0:
-        raise ValueError('lo must be non-negative')
-    if hi is None:
-        hi = len(a)
-    # Note, the comparison uses "<" to match the
-    # __lt__() logic in list.sort() and in heapq.
-    if key is None:
-        while lo < hi:
-            mid = (lo + hi) // 2
-            if a[mid] < x:
-                lo = mid + 1
-            else:
-                hi = mid
-    else:
-        while lo < hi:
-            mid = (lo + hi) // 2
-            if key(a[mid]) < x:
-                lo = mid + 1
-            else:
-                hi = mid
-    return lo
+# channels delivered to at once when firing a batch
+DELIVERY_CONCURRENCY = 16
+# ids per SELECT, to stay under SQLite's bound parameter limit
+FETCH_BATCH = 500
+# times to redo a batch's expiry transaction if another task's rollback discards it
+EXPIRE_ATTEMPTS = 3
+
+# shortest interval allowed for recurring reminders, in seconds
+MIN_RECURRENCE = 300
+# most reminders importreminders accepts at once
+IMPORT_LIMIT = 1000
+
+# expired reminders are moved to reminders_archive this long after they were due, in batches, by the archiver
+ARCHIVE_AFTER = 86400
+ARCHIVE_BATCH = 1000
+ARCHIVE_INTERVAL = 3600
+
+# reminders due within this long of each other are fired together
+BATCH_WINDOW = 1.0
+
+class Scheduler:
+    """Min-heap of (time, id) with lazy deletion: cancelled or rescheduled entries stay in the heap and are skipped when they reach the top.
+    pending holds the current time for each scheduled id."""
+    def __init__(self):
+        self.heap = []
+        self.pending = {}
+        self.wakeup = asyncio.Event()
+
+    def __len__(self): return len(self.pending)
+    def __contains__(self, id): return id in self.pending
+
+    def load(self, entries):
+        "Bulk-load (id, time) pairs in linear time."
+        self.pending.update(entries)
+        self.heap = [ (time, id) for id, time in self.pending.items() ]
+        heapq.heapify(self.heap)
+        self.wakeup.set()
+
+    def compact(self):
+        # stale entries can build up with heavy rescheduling/cancellation
+        if len(self.heap) > 2 * len(self.pending) + 1024:
+            self.heap = [ (time, id) for id, time in self.pending.items() ]
+            heapq.heapify(self.heap)
+
+    def schedule(self, id, time):
+        "Schedule id at time, replacing any existing time for it."
+        self.pending[id] = time
+        heapq.heappush(self.heap, (time, id))
+        if self.heap[0] == (time, id): self.wakeup.set()
+        self.compact()
+
+    def cancel(self, id):
+        if self.pending.pop(id, None) is None: return False
+        self.wakeup.set()
+        self.compact()
+        return True
+
+    def next_time(self):
+        while self.heap:
+            time, id = self.heap[0]
+            if self.pending.get(id) == time: return time
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, now):
+        due = []
+        while (time := self.next_time()) is not None and time <= now:
+            _, id = heapq.heappop(self.heap)
+            del self.pending[id]
+            due.append(id)
+        return due
+
+    async def wait(self):
+        "Wait until at least one reminder is due, then return the ids of all those due in this batch window, in time order."
+        while True:
+            self.wakeup.clear()
+            next_time = self.next_time()
+            if next_time is None:
+                await self.wakeup.wait()
+                continue
+            delay = next_time - util.timestamp()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                    continue
+                except asyncio.TimeoutError: pass
+            due = self.pop_due(util.timestamp() + BATCH_WINDOW)
+            if due: return due
+
+def next_occurrence(extra):
+    "Advance a recurring reminder's extra data past the current time, returning the next remind timestamp and the new extra (JSON)."
+    delta = util.cached_short_timedelta(extra["recurrence"])
+    start = datetime.fromtimestamp(extra["recurrence_start"], tz=timezone.utc)
+    now = datetime.now(tz=timezone.utc)
+    # offsets are from the first occurrence, so month-based intervals don't drift at month ends
+    occurrence = extra["occurrence"] + 1
+    while (next_time := start + delta * occurrence) <= now: occurrence += 1
+    extra = { **extra, "occurrence": occurrence }
+    return next_time.timestamp(), util.json_encode(extra)
 
 class Reminders(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.reminder_queue = []
-        self.reminder_event = asyncio.Event()
+        self.scheduler = Scheduler()
+        self.rloop_task = None
+        self.archive_task = None
 
-    @commands.command(brief="Set a reminder to be reminded about later.", rest_is_raw=True, help="""Sets a reminder which you will (probably) be reminded about at/after the specified time.
-    All times are UTC unless overridden.
-    Thanks to new coding and algorithms, reminders are now not done at minute granularity. However, do not expect sub-5s granularity due to miscellaneous latency which has not been a significant target of optimization.
-    Note that due to technical limitations reminders beyond the year 10000 CE or in the past cannot currently be handled.
-    Note that reminder delivery is not guaranteed, due to possible issues including but not limited to: data loss, me eventually not caring, the failure of Discord (in this case message delivery will still be attempted manually on a case-by-case basis), the collapse of human civilization, or other existential risks.""")
-    async def remind(self, ctx, time, *, reminder, notify=True):
+    async def insert_reminders(self, reminders):
+        "Insert (remind_timestamp, created_timestamp, reminder text, extra) tuples in one transaction and schedule them, returning their ids."
+        ids = []
+        async with self.bot.database.transaction():
+            for remind_timestamp, created_timestamp, reminder, extra in reminders:
+                ids.append((await self.bot.database.execute_insert("INSERT INTO reminders (remind_timestamp, created_timestamp, reminder, expired, extra) VALUES (?, ?, ?, ?, ?)",
+                    (remind_timestamp, created_timestamp, reminder, 0, util.json_encode(extra))))["last_insert_rowid()"])
+        for id, (remind_timestamp, *_) in zip(ids, reminders):
+            self.insert_reminder(id, remind_timestamp)
+        return ids
+
+    async def schedule_from_command(self, ctx, time, reminder, recurrence=None):
         reminder = reminder.strip()
         if len(reminder) > 512:
             await ctx.send(embed=util.error_embed("Maximum reminder length is 512 characters", "Foolish user error"))
@@ -71,17 +152,97 @@ class Reminders(commands.Cog):
             await ctx.send(embed=util.error_embed("Invalid time (wrong format/too large months or years)"))
             return
         utc_time, local_time = util.in_timezone(time, tz)
-        id = (await self.bot.database.execute_insert("INSERT INTO reminders (remind_timestamp, created_timestamp, reminder, expired, extra) VALUES (?, ?, ?, ?, ?)",
-            (utc_time.timestamp(), now.timestamp(), reminder, 0, util.json_encode(extra_data))))["last_insert_rowid()"]
+        if recurrence:
+            extra_data["recurrence"] = recurrence
+            extra_data["recurrence_start"] = utc_time.timestamp()
+            extra_data["occurrence"] = 0
+        [id] = await self.insert_reminders([(utc_time.timestamp(), now.timestamp(), reminder, extra_data)])
+        return id, now, utc_time, local_time
+
+    @commands.command(brief="Set a reminder to be reminded about later.", rest_is_raw=True, help="""Sets a reminder which you will (probably) be reminded about at/after the specified time.
+    All times are UTC unless overridden.
+    Thanks to new coding and algorithms, reminders are now not done at minute granularity. However, do not expect sub-5s granularity due to miscellaneous latency which has not been a significant target of optimization.
+    Note that due to technical limitations reminders beyond the year 10000 CE or in the past cannot currently be handled.
+    Note that reminder delivery is not guaranteed, due to possible issues including but not limited to: data loss, me eventually not caring, the failure of Discord (in this case message delivery will still be attempted manually on a case-by-case basis), the collapse of human civilization, or other existential risks.""")
+    async def remind(self, ctx, time, *, reminder, notify=True):
+        scheduled = await self.schedule_from_command(ctx, time, reminder)
+        if scheduled and notify:
+            id, now, utc_time, local_time = scheduled
+            await ctx.send(f"Reminder scheduled for {util.format_time(local_time)} ({util.format_timedelta(now, utc_time)}).")
+
+    @commands.command(brief="Set a reminder which repeats at a fixed interval.", rest_is_raw=True, help="""Sets a reminder which fires first at/after the specified time, then every interval (in the short format, e.g. 1d or 1w2d) until cancelled with unremind.
+    Occurrences missed while the bot is down are skipped, not fired all at once.""")
+    async def recur(self, ctx, interval, time, *, reminder):
+        try:
+            delta, deterministic = util.short_timedelta(interval)
+            now = datetime.now(tz=timezone.utc)
+            if not deterministic or ((now + delta) - now).total_seconds() < MIN_RECURRENCE: raise ValueError("interval too short")
+        except (ValueError, OverflowError):
+            await ctx.send(embed=util.error_embed(f"Invalid interval (use the short format, at least {MIN_RECURRENCE}s, nothing random)"))
+            return
+        scheduled = await self.schedule_from_command(ctx, time, reminder, interval)
+        if scheduled:
+            id, now, utc_time, local_time = scheduled
+            await ctx.send(f"Recurring reminder {id} scheduled for {util.format_time(local_time)} ({util.format_timedelta(now, utc_time)}) and every {interval} after.")
+
+    @commands.command(brief="Cancel one of your pending reminders.")
+    async def unremind(self, ctx, id: int):
+        row = await self.bot.database.execute_fetchone("SELECT * FROM reminders WHERE id = ? AND expired = 0", (id,))
+        if not row or json.loads(row["extra"])["author_id"] != ctx.author.id:
+            await ctx.send(embed=util.error_embed("No such pending reminder of yours"))
+            return
+        await self.bot.database.execute("UPDATE reminders SET expired = 3 WHERE id = ?", (id,)) # 3 = cancelled
         await self.bot.database.commit()
-        if notify: await ctx.send(f"Reminder scheduled for {util.format_time(local_time)} ({util.format_timedelta(now, utc_time)}).")
-        self.insert_reminder(id, utc_time.timestamp())
+        self.scheduler.cancel(id)
+        await ctx.send(f"Reminder {id} cancelled.")
+
+    async def pending_reminders(self, author_id):
+        rows = await self.bot.database.execute_fetchall("SELECT * FROM reminders WHERE expired = 0 ORDER BY remind_timestamp")
+        for row in rows:
+            extra = json.loads(row["extra"])
+            if extra["author_id"] == author_id: yield row, extra
+
+    @commands.command(brief="Export your pending reminders as JSON.")
+    async def exportreminders(self, ctx):
+        out = [ { "id": row["id"], "remind_timestamp": row["remind_timestamp"], "created_timestamp": row["created_timestamp"], "reminder": row["reminder"], "recurrence": extra.get("recurrence") }
+            async for row, extra in self.pending_reminders(ctx.author.id) ]
+        await ctx.send(f"{len(out)} pending reminders.", file=discord.File(io.BytesIO(util.json_encode(out).encode("utf-8")), filename="reminders.json"))
+
+    @commands.command(brief="Import reminders from attached JSON.", help=f"""Import reminders from a JSON file (in exportreminders format) attached to the command message, in one transaction.
+    They will be delivered to this channel. Reminders in the past or otherwise invalid are skipped. At most {IMPORT_LIMIT} at once.""")
+    async def importreminders(self, ctx):
+        if not ctx.message.attachments: raise ValueError("No file attached")
+        entries = json.loads(await ctx.message.attachments[0].read())
+        if len(entries) > IMPORT_LIMIT: raise ValueError(f"At most {IMPORT_LIMIT} reminders can be imported at once")
+        now = datetime.now(tz=timezone.utc)
+        reminders = []
+        for entry in entries:
+            try:
+                remind_timestamp = float(entry["remind_timestamp"])
+                reminder = str(entry["reminder"]).strip()
+                recurrence = entry.get("recurrence")
+                if remind_timestamp <= now.timestamp() or len(reminder) > 512: continue
+                extra = {
+                    "author_id": ctx.author.id,
+                    "channel_id": ctx.message.channel.id,
+                    "message_id": ctx.message.id,
+                    "guild_id": ctx.message.guild and ctx.message.guild.id,
+                    "original_time_spec": None
+                }
+                if recurrence:
+                    delta, deterministic = util.short_timedelta(recurrence)
+                    if not deterministic or ((now + delta) - now).total_seconds() < MIN_RECURRENCE: continue
+                    extra["recurrence"] = recurrence
+                    extra["recurrence_start"] = remind_timestamp
+                    extra["occurrence"] = 0
+            except (KeyError, TypeError, ValueError, OverflowError):
+                continue
+            reminders.append((remind_timestamp, now.timestamp(), reminder, extra))
+        await self.insert_reminders(reminders)
+        await ctx.send(f"Imported {len(reminders)} reminders, skipped {len(entries) - len(reminders)}.")
 
     def insert_reminder(self, id, time):
-        pos = bisect_left(self.reminder_queue, time, key=lambda x: x[0])
-        self.reminder_queue.insert(pos, (time, id))
-        if pos == 0:
-            self.reminder_event.set()
+        self.scheduler.schedule(id, time)
 
     async def send_to_channel(self, info, text):
         channel = self.bot.get_channel(info["channel_id"])
@@ -100,88 +261,154 @@ class Reminders(commands.Cog):
         if not "guild_id" in info: raise Exception("Guild unknown")
         guild = self.bot.get_guild(info["guild_id"])
         member = guild.get_member(info["author_id"])
-        self = guild.get_member(bot.user.id)
+        me = guild.get_member(self.bot.user.id)
         # if member is here, find a channel they can read and the bot can send in
         if member:
             for chan in guild.text_channels:
-                if chan.permissions_for(member).read_messages and chan.permissions_for(self).send_messages:
+                if chan.permissions_for(member).read_messages and chan.permissions_for(me).send_messages:
                     await chan.send(text)
                     return
         # if member not here or no channel they can read messages in, send to any available channel
         for chan in guild.text_channels:
-            if chan.permissions_for(self).send_messages:
+            if chan.permissions_for(me).send_messages:
                 await chan.send(text)
                 return
         raise Exception(f"guild {info['author_id']} has no (valid) channels")
 
-    async def fire_reminder(self, id):
+    async def deliver_reminder(self, row, extra, timezones):
+        "Try each delivery method in turn for one reminder, returning whether any succeeded. timezones caches user timezone lookups across a batch."
         remind_send_methods = [
             ("original channel", self.send_to_channel),
             ("direct message", self.send_by_dm),
             ("originating guild", self.send_to_guild)
         ]
-        row = await self.bot.database.execute_fetchone("SELECT * FROM reminders WHERE id = ?", (id,))
-        to_expire = []
-        rid, remind_timestamp, created_timestamp, reminder_text, _, extra = row
+        rid, remind_timestamp, created_timestamp, reminder_text, _, _ = row
         try:
-            remind_timestamp = datetime.utcfromtimestamp(remind_timestamp)
             created_timestamp = datetime.utcfromtimestamp(created_timestamp).replace(tzinfo=timezone.utc)
-            extra = json.loads(extra)
             uid = extra["author_id"]
-            tz = await util.get_user_timezone(util.AltCtx(util.IDWrapper(uid), util.IDWrapper(extra.get("guild_id")), self.bot))
+            key = (uid, extra.get("guild_id"))
+            tz = timezones.get(key)
+            if tz is None:
+                tz = timezones[key] = await util.get_user_timezone(util.AltCtx(util.IDWrapper(uid), util.IDWrapper(extra.get("guild_id")), self.bot))
             created_time = util.format_time(created_timestamp.astimezone(tz))
             text = f"<@{uid}> Reminder queued at {created_time}: {reminder_text}"
-
-            for method_name, func in remind_send_methods:
-                try:
-                    await func(extra, text)
-                    metrics.reminders_fired.inc()
-                    to_expire.append((1, rid)) # 1 = expired normally
-                    break
-                except Exception as e: logging.warning("Failed to send %d to %s", rid, method_name, exc_info=e)
+            if "recurrence" in extra: text += f" (repeats every {extra['recurrence']}; unremind {rid} to stop)"
         except Exception as e:
             logging.warning("Could not send reminder %d", rid, exc_info=e)
-            #to_expire.append((2, rid)) # 2 = errored
-        for expiry_type, expiry_id in to_expire:
-            logging.info("Expiring reminder %d", expiry_id)
-            await self.bot.database.execute("UPDATE reminders SET expired = ? WHERE id = ?", (expiry_type, expiry_id))
-        await self.bot.database.commit()
+            return False
+        for method_name, func in remind_send_methods:
+            try:
+                await func(extra, text)
+                metrics.reminders_fired.inc()
+                return True
+            except Exception as e: logging.warning("Failed to send %d to %s", rid, method_name, exc_info=e)
+        return False
+
+    async def fire_reminders(self, ids):
+        "Deliver a batch of reminders concurrently across channels (in time order within each), then expire the delivered ones in one transaction."
+        start = time.perf_counter()
+        rows = []
+        for chunk in util.chunks(ids, FETCH_BATCH):
+            rows.extend(await self.bot.database.execute_fetchall(f"SELECT * FROM reminders WHERE expired = 0 AND id IN ({', '.join('?' * len(chunk))})", chunk))
+        rows.sort(key=lambda row: row["remind_timestamp"])
+        by_channel = collections.defaultdict(list)
+        for row in rows:
+            try:
+                extra = json.loads(row["extra"])
+            except Exception as e:
+                logging.warning("Could not send reminder %d", row["id"], exc_info=e)
+                continue
+            by_channel[extra.get("channel_id")].append((row, extra))
+
+        to_expire = []
+        to_advance = []
+        timezones = {}
+        semaphore = asyncio.Semaphore(DELIVERY_CONCURRENCY)
+        async def deliver_channel(reminders):
+            async with semaphore:
+                for row, extra in reminders:
+                    delivered = await self.deliver_reminder(row, extra, timezones)
+                    if "recurrence" in extra:
+                        # recurring reminders move on to their next occurrence even if this one failed, so they can't get stuck
+                        try:
+                            to_advance.append((*next_occurrence(extra), row["id"]))
+                        except Exception as e:
+                            logging.warning("Could not reschedule recurring reminder %d", row["id"], exc_info=e)
+                            to_expire.append((2, row["id"])) # 2 = errored
+                    elif delivered:
+                        to_expire.append((1, row["id"])) # 1 = expired normally
+        await asyncio.gather(*map(deliver_channel, by_channel.values()))
+
+        if to_expire or to_advance:
+            try:
+                # the updates can just be redone if another task's rollback discards them, as they don't depend on the current state
+                for attempt in range(EXPIRE_ATTEMPTS):
+                    try:
+                        async with self.bot.database.transaction():
+                            await self.bot.database.executemany("UPDATE reminders SET expired = ? WHERE id = ?", to_expire)
+                            await self.bot.database.executemany("UPDATE reminders SET remind_timestamp = ?, extra = ? WHERE id = ?", to_advance)
+                        break
+                    except db.RolledBack:
+                        if attempt == EXPIRE_ATTEMPTS - 1: raise
+                        logging.warning("Expiry of %d reminders discarded by a rollback, retrying", len(to_expire) + len(to_advance))
+            finally:
+                # recurring reminders were delivered either way, so schedule their next occurrence even if it couldn't be saved;
+                # the row is still pending, and firing it then advances it from its stored occurrence
+                for remind_timestamp, _, id in to_advance:
+                    self.insert_reminder(id, remind_timestamp)
+        logging.info("Fired %d/%d reminders in %.2fs", len(to_expire) + len(to_advance), len(ids), time.perf_counter() - start)
 
     async def init_reminders(self):
-        ts = util.timestamp()
-        # load future reminders
-        reminders = await self.bot.database.execute_fetchall("SELECT * FROM reminders WHERE expired = 0 AND remind_timestamp > ?", (ts,))
-        for reminder in reminders:
-            self.insert_reminder(reminder["id"], reminder["remind_timestamp"])
-        logging.info("Loaded %d reminders", len(reminders))
-        self.rloop_task = await self.reminder_loop()
-        # catch reminders which were not fired due to downtime or something
-        reminders = await self.bot.database.execute_fetchall("SELECT * FROM reminders WHERE expired = 0 AND remind_timestamp <= ?", (ts,))
-        logging.info("Firing %d late reminders", len(reminders))
-        for reminder in reminders:
-            await self.fire_reminder(reminder["id"])
+        start = time.perf_counter()
+        # load pending reminders, including late ones which were not fired due to downtime or something:
+        # those are due immediately, so reminder_loop fires them as a batch once the bot is ready to deliver them
+        reminders = await self.bot.database.execute_fetchall("SELECT id, remind_timestamp FROM reminders WHERE expired = 0")
+        self.scheduler.load((reminder["id"], reminder["remind_timestamp"]) for reminder in reminders)
+        elapsed = time.perf_counter() - start
+        metrics.reminders_startup.set(elapsed)
+        late = sum(1 for reminder in reminders if reminder["remind_timestamp"] <= util.timestamp())
+        logging.info("Loaded %d reminders (%d late) in %.2fs", len(reminders), late, elapsed)
+        self.rloop_task = asyncio.create_task(self.reminder_loop())
+        self.archive_task = asyncio.create_task(self.archive_loop())
 
     async def reminder_loop(self):
         await self.bot.wait_until_ready()
         while True:
+            due = await self.scheduler.wait()
             try:
-                next_time, next_id = self.reminder_queue[0]
-            except IndexError:
-                await self.reminder_event.wait()
-                self.reminder_event.clear()
-            else:
-                try:
-                    await asyncio.wait_for(self.reminder_event.wait(), next_time - util.timestamp())
-                    self.reminder_event.clear()
-                except asyncio.TimeoutError:
-                    self.reminder_event.clear()
-                    self.reminder_queue.pop(0)
-                    await self.fire_reminder(next_id)
+                await self.fire_reminders(due)
+            except Exception as e:
+                logging.warning("Could not fire %d reminders", len(due), exc_info=e)
+
+    async def archive_expired(self):
+        "Move reminders which expired over ARCHIVE_AFTER ago to reminders_archive, a batch per transaction so other writers aren't held up for long."
+        cutoff = util.timestamp() - ARCHIVE_AFTER
+        total = 0
+        while True:
+            ids = [ row["id"] for row in await self.bot.database.execute_fetchall("SELECT id FROM reminders WHERE expired != 0 AND remind_timestamp < ? LIMIT ?", (cutoff, ARCHIVE_BATCH)) ]
+            if not ids: break
+            placeholders = ", ".join("?" * len(ids))
+            async with self.bot.database.transaction():
+                await self.bot.database.execute(f"INSERT OR REPLACE INTO reminders_archive SELECT * FROM reminders WHERE id IN ({placeholders})", ids)
+                await self.bot.database.execute(f"DELETE FROM reminders WHERE id IN ({placeholders})", ids)
+            metrics.reminders_archived.inc(len(ids))
+            total += len(ids)
+            await asyncio.sleep(0)
+        if total: logging.info("Archived %d expired reminders", total)
+
+    async def archive_loop(self):
+        while True:
+            try:
+                await self.archive_expired()
+            except Exception as e:
+                logging.warning("Could not archive reminders", exc_info=e)
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+    def cog_unload(self):
+        if self.rloop_task: self.rloop_task.cancel()
+        if self.archive_task: self.archive_task.cancel()
 
 async def setup(bot):
     cog = Reminders(bot)
     await bot.add_cog(cog)
     asyncio.create_task(cog.init_reminders())
-
-async def teardown(bot):
-    bot.rloop_task.cancel()
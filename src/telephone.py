@@ -4,65 +4,206 @@ import logging
 import asyncio
 import re
 import hashlib
-from datetime import datetime, timedelta
+from datetime import datetime
 import os
 import pydot
-import tempfile
+import io
+import json
 import collections
-import aiohttp
+import time
+import prometheus_client
+import random
 
 import util
 import eventbus
+import db
+
+WORDLIST = tuple(word.strip().title() for word in open(os.path.join(os.path.dirname(__file__), "../wordlist-8192.txt")))
 
 # Generate a "phone" address
 # Not actually for phones
-def generate_address(ctx):
-    h = hashlib.blake2b(str(ctx.guild.id).encode("utf-8")).digest()
-    words = open("wordlist-8192.txt").readlines()
-    out = ""
-    for i in range(3):
-        out += words[int.from_bytes(h[i * 2:i * 2 + 3], "little") % 8192].strip().title()
-    return out
+# Addresses are three words picked by hashing the guild ID; if that collides with an address taken by something else,
+# the ID is rehashed with an attempt counter, so the result is deterministic given the same taken addresses.
+def generate_address(guild_id, taken=lambda address: False):
+    attempt = 0
+    while True:
+        seed = str(guild_id) if attempt == 0 else f"{guild_id}/{attempt}"
+        h = hashlib.blake2b(seed.encode("utf-8")).digest()
+        address = "".join(WORDLIST[int.from_bytes(h[i * 2:i * 2 + 3], "little") % len(WORDLIST)] for i in range(3))
+        if not taken(address): return address
+        attempt += 1
+
+def generate_addresses(guild_ids, taken=lambda address: False):
+    "Assign addresses to many guilds at once (e.g. for migrations). Guilds are processed in ID order so collisions between them resolve the same way every time."
+    assigned = {}
+    used = set()
+    for guild_id in sorted(guild_ids):
+        address = generate_address(guild_id, lambda address: address.casefold() in used or taken(address))
+        used.add(address.casefold())
+        assigned[guild_id] = address
+    return assigned
+
+MENTION_REGEX = re.compile(r"<([@#])!?([0-9]+)>")
+
+# (sigil, id) -> resolved mention segment; entries are dropped when the user/channel changes
+mention_cache = util.LRUCache(4096)
+# (guild id, user id) -> True for users known to be members of that guild, for rendering mentions at the destination
+# only members are cached: a miss may just mean the guild's members haven't been fetched yet (e.g. before READY)
+member_cache = util.LRUCache(16384)
+
+def resolve_mention(bot, sigil, target):
+    key = (sigil, target)
+    seg = mention_cache.get(key)
+    if seg is not None: return seg
+    if sigil == "@": # user ping
+        user = bot.get_user(target)
+        if not user: return f"@{target}"
+        seg = { "type": "user_mention", "name": user.name, "id": target }
+    else: # channel "ping"
+        channel = bot.get_channel(target)
+        if not channel: return f"#{target}"
+        seg = { "type": "channel_mention", "name": channel.name, "id": target }
+    mention_cache[key] = seg
+    return seg
 
 def parse_formatting(bot, text):
-    def parse_match(m):
-        try:
-            target = int(m.group(2))
-        except ValueError: return m.string
-        if m.group(1) == "@": # user ping
-            user = bot.get_user(target)
-            if user: return { "type": "user_mention", "name": user.name, "id": target }
-            return f"@{target}"
-        else: # channel "ping"
-            channel = bot.get_channel(target)
-            if channel: return { "type": "channel_mention", "name": channel.name, "id": target }
-            return f"#{target}"
-    remaining = text
     out = []
-    while match := re.search(r"<([@#])!?([0-9]+)>", remaining):
+    pos = 0
+    for match in MENTION_REGEX.finditer(text):
         start, end = match.span()
-        out.append(remaining[:start])
-        out.append(parse_match(match))
-        remaining = remaining[end:]
-    out.append(remaining)
-    return list(filter(lambda x: x != "", out))
+        if start > pos: out.append(text[pos:start])
+        out.append(resolve_mention(bot, match.group(1), int(match.group(2))))
+        pos = end
+    if pos < len(text): out.append(text[pos:])
+    return out
+
+def is_member(guild, user_id):
+    key = (guild.id, user_id)
+    if member_cache.get(key): return True
+    if guild.get_member(user_id) is None: return False
+    member_cache[key] = True
+    return True
 
 def render_formatting(dest_channel, message):
-    out = ""
+    out = []
     for seg in message:
         if isinstance(seg, str):
-            out += seg
+            out.append(seg)
         else:
             kind = seg["type"]
-            # TODO: use python 3.10 pattern matching
             if kind == "user_mention":
-                member = dest_channel.guild.get_member(seg["id"])
-                if member != None: out += f"<@{member.id}>"
-                else: out += f"@{seg['name']}"
+                out.append(f"<@{seg['id']}>" if is_member(dest_channel.guild, seg["id"]) else f"@{seg['name']}")
             elif kind == "channel_mention": # these appear to be clickable across servers/guilds
-                out += f"<#{seg['id']}>"
+                out.append(f"<#{seg['id']}>")
             else: logging.warn("Unrecognized message seg %s", kind)
-    return out
+    return "".join(out)
+
+# message ID -> (author, parsed content) for recently bridged messages, so replies to them need no API calls
+reply_cache = util.LRUCache(20000)
+
+# webhook sends are sharded across this many workers by channel, so a slow/rate-limited channel only holds up its own shard
+WEBHOOK_SENDERS = 8
+
+# bridged messages are indexed locally (for searchrecent/delrecent) for this long
+INDEX_RETENTION = 60 * 60 * 24 * 7 # s
+INDEX_FLUSH_INTERVAL = 5 # s
+DELETE_PARALLELISM = 8
+
+webhook_queue_overflows = prometheus_client.Counter("abr_telephone_webhook_overflows", "Bridged messages sent normally because the webhook queue was full")
+webhook_send_latency = prometheus_client.Histogram("abr_telephone_webhook_send_latency", "Time between bridged messages being queued for webhook send and being sent")
+
+class Directory:
+    "Write-through in-memory copy of telephone_config and calls. Callers use commit after making changes, which reloads the copy if the writes were rolled back."
+    def __init__(self, db):
+        self.db = db
+        # casefolded address -> config row (addresses are matched case-insensitively)
+        self.addresses = {}
+        self.channels = {}
+        # addresses available for random dialling, with positions so they can be removed in O(1)
+        self.enabled = []
+        self.enabled_index = {}
+        self.calls_from = {}
+        # to address -> { from address -> call row }
+        self.calls_to = {}
+
+    async def load(self):
+        for index in (self.addresses, self.channels, self.enabled, self.enabled_index, self.calls_from, self.calls_to): index.clear()
+        configs = await self.db.execute_fetchall("SELECT * FROM telephone_config")
+        for row in configs: self.index_config(dict(row))
+        calls = await self.db.execute_fetchall("SELECT * FROM calls")
+        for row in calls: self.index_call(dict(row))
+        logging.info("Loaded %d telephone addresses and %d calls", len(configs), len(calls))
+
+    async def commit(self):
+        try:
+            await self.db.commit()
+        except db.RolledBack:
+            # another task's rollback discarded our writes, so the in-memory state no longer matches the DB
+            await self.load()
+            raise
+
+    def index_config(self, row):
+        self.addresses[row["id"].casefold()] = row
+        self.channels[row["channel_id"]] = row
+        if row["disabled"] == 0: self.add_enabled(row["id"])
+
+    def unindex_config(self, row):
+        if self.addresses.get(row["id"].casefold()) is not row: return
+        del self.addresses[row["id"].casefold()]
+        del self.channels[row["channel_id"]]
+        self.remove_enabled(row["id"])
+
+    def add_enabled(self, addr):
+        if addr in self.enabled_index: return
+        self.enabled_index[addr] = len(self.enabled)
+        self.enabled.append(addr)
+
+    def remove_enabled(self, addr):
+        i = self.enabled_index.pop(addr, None)
+        if i is None: return
+        last = self.enabled.pop()
+        if last != addr:
+            self.enabled[i] = last
+            self.enabled_index[last] = i
+
+    def get_address(self, addr): return self.addresses.get(addr.casefold())
+    def address_taken(self, addr, guild_id):
+        row = self.get_address(addr)
+        return row is not None and row["guild_id"] != guild_id
+    def get_channel(self, channel_id): return self.channels.get(channel_id)
+    def random_enabled(self): return random.choice(self.enabled) if self.enabled else None
+
+    async def configure(self, addr, guild_id, channel_id, webhook):
+        await self.db.execute("INSERT OR REPLACE INTO telephone_config VALUES (?, ?, ?, ?, 0)", (addr, guild_id, channel_id, webhook))
+        # the replace drops any existing rows with this address or this channel
+        for old in (self.get_address(addr), self.get_channel(channel_id)):
+            if old: self.unindex_config(old)
+        self.index_config({ "id": addr, "guild_id": guild_id, "channel_id": channel_id, "webhook": webhook, "disabled": 0 })
+
+    async def disable(self, addr):
+        row = self.get_address(addr)
+        await self.db.execute("UPDATE telephone_config SET disabled = 1 WHERE id = ?", (row["id"],))
+        row["disabled"] = 1
+        self.remove_enabled(row["id"])
+
+    def index_call(self, row):
+        self.calls_from[row["from_id"]] = row
+        self.calls_to.setdefault(row["to_id"], {})[row["from_id"]] = row
+
+    async def add_call(self, from_id, to_id, start_time):
+        await self.db.execute("INSERT INTO calls VALUES (?, ?, ?)", (from_id, to_id, start_time))
+        self.index_call({ "from_id": from_id, "to_id": to_id, "start_time": start_time })
+
+    async def remove_call(self, from_id, to_id):
+        await self.db.execute("DELETE FROM calls WHERE from_id = ? AND to_id = ?", (from_id, to_id))
+        self.calls_from.pop(from_id, None)
+        incoming = self.calls_to.get(to_id)
+        if incoming is not None:
+            incoming.pop(from_id, None)
+            if not incoming: del self.calls_to[to_id]
+
+    def outgoing(self, addr): return self.calls_from.get(addr)
+    def incoming(self, addr): return list(self.calls_to.get(addr, {}).values())
 
 class Telephone(commands.Cog):
     # Discord event bus link
@@ -70,18 +211,68 @@ class Telephone(commands.Cog):
     def __init__(self, bot):
         self.webhooks = {}
         self.bot = bot
-        self.unlisten = eventbus.add_listener("discord", self.on_bridge_message)
-        self.webhook_queue = asyncio.Queue(50)
-        self.webhook_queue_handler_task = asyncio.create_task(self.send_webhooks())
+        self.directory = Directory(bot.database)
+        self.unlisten = eventbus.add_listener("discord", self.on_bridge_message, batched=True)
+        self.webhook_objects = {}
+        self.webhook_queues = [ asyncio.Queue(50) for _ in range(WEBHOOK_SENDERS) ]
+        self.webhook_sender_tasks = [ asyncio.create_task(self.send_webhooks(queue)) for queue in self.webhook_queues ]
+        self.index_buffer = []
+        self.reply_fetches = set()
+        self.index_task = asyncio.create_task(self.maintain_index())
+
+    def get_webhook(self, url):
+        try:
+            return self.webhook_objects[url]
+        except KeyError:
+            wh_obj = self.webhook_objects[url] = discord.Webhook.from_url(url, session=self.bot.http._HTTPClient__session)
+            return wh_obj
 
-    async def send_webhooks(self):
+    async def send_webhooks(self, queue):
+        # discord.py tracks per-webhook rate limit buckets from response headers and waits them out (or retries on 429) inside send
         while True:
-            webhook, content, username, avatar_url = await self.webhook_queue.get()
-            wh_obj = discord.Webhook.from_url(webhook, session=self.bot.http._HTTPClient__session)
+            channel_id, webhook, content, author, queued_at = await queue.get()
             try:
-                await wh_obj.send(content=content, username=username, avatar_url=avatar_url, allowed_mentions=discord.AllowedMentions(everyone=False, roles=False, users=False))
-            except:
-                logging.exception("Webhook send on %s failed")
+                sent = await self.get_webhook(webhook).send(content=content, username=author.name, avatar_url=author.avatar_url, allowed_mentions=discord.AllowedMentions(everyone=False, roles=False, users=False), wait=True)
+                webhook_send_latency.observe(time.monotonic() - queued_at)
+                self.index_message(sent.id, channel_id, author.name, True, content)
+                reply_cache[sent.id] = (author, parse_formatting(self.bot, content))
+            except Exception:
+                logging.exception("Webhook send on %d failed", channel_id)
+
+    def index_message(self, message_id, channel_id, author, webhook, content):
+        self.index_buffer.append((message_id, channel_id, author, int(webhook), util.timestamp(), content))
+
+    async def flush_index(self):
+        if not self.index_buffer: return
+        batch, self.index_buffer = self.index_buffer, []
+        await self.bot.database.executemany("INSERT OR REPLACE INTO bridged_messages VALUES (?, ?, ?, ?, ?)", [ row[:5] for row in batch ])
+        await self.bot.database.executemany("INSERT OR REPLACE INTO bridged_messages_fts (rowid, content) VALUES (?, ?)", [ (row[0], row[5]) for row in batch ])
+        # the index is best-effort, so doesn't need to wait for durability
+        await self.bot.database.commit(wait=False)
+
+    async def prune_index(self):
+        cutoff = util.timestamp() - INDEX_RETENTION
+        await self.bot.database.execute("DELETE FROM bridged_messages_fts WHERE rowid IN (SELECT message_id FROM bridged_messages WHERE timestamp < ?)", (cutoff,))
+        await self.bot.database.execute("DELETE FROM bridged_messages WHERE timestamp < ?", (cutoff,))
+        await self.bot.database.commit()
+
+    async def forget_messages(self, message_ids):
+        await self.bot.database.executemany("DELETE FROM bridged_messages_fts WHERE rowid = ?", [ (id,) for id in message_ids ])
+        await self.bot.database.executemany("DELETE FROM bridged_messages WHERE message_id = ?", [ (id,) for id in message_ids ])
+        await self.bot.database.commit()
+
+    async def maintain_index(self):
+        # writes are buffered and flushed periodically to avoid a commit per bridged message
+        last_prune = 0
+        while True:
+            await asyncio.sleep(INDEX_FLUSH_INTERVAL)
+            try:
+                await self.flush_index()
+                if util.timestamp() - last_prune > 3600:
+                    await self.prune_index()
+                    last_prune = util.timestamp()
+            except Exception:
+                logging.exception("Bridged message index maintenance failed")
 
     async def initial_load_webhooks(self):
         rows = await self.bot.database.execute_fetchall("SELECT * FROM discord_webhooks")
@@ -89,26 +280,48 @@ class Telephone(commands.Cog):
             self.webhooks[row["channel_id"]] = row["webhook"]
         logging.info("Loaded %d webhooks", len(rows))
 
-    async def on_bridge_message(self, channel_id, msg: eventbus.Message):
+    async def send_bridged(self, channel, author: eventbus.AuthorInfo, content, attachments):
+        webhook = self.webhooks.get(channel.id)
+        attachments_text = "\n".join(f"{at.filename}: {at.proxy_url}" for at in attachments)
+        async def send_normally(text):
+            text = f"<{author.name}> {text}"[:2000]
+            sent = await channel.send(text, allowed_mentions=discord.AllowedMentions(everyone=False, roles=False, users=False))
+            self.index_message(sent.id, channel.id, author.name, False, text)
+        async def send_raw(text):
+            if webhook:
+                try:
+                    self.webhook_queues[channel.id % WEBHOOK_SENDERS].put_nowait((channel.id, webhook, text, author, time.monotonic()))
+                except asyncio.QueueFull:
+                    webhook_queue_overflows.inc()
+                    await send_normally(text)
+            else:
+                await send_normally(text)
+        await send_raw(content)
+        if attachments_text: await send_raw(attachments_text)
+
+    def render_bridged(self, channel, msg: eventbus.Message):
+        content = render_formatting(channel, msg.message)[:2000]
+        if channel.id in util.config["bridge_show_src"] and msg.source[0] == "discord":
+            content = f"<#{msg.source[1]}> " + content
+        return content
+
+    async def on_bridge_message(self, channel_id, msgs: list[eventbus.Message]):
         channel = self.bot.get_channel(channel_id)
         if channel:
-            webhook = self.webhooks.get(channel_id)
-            attachments_text = "\n".join(f"{at.filename}: {at.proxy_url}" for at in msg.attachments)
-            async def send_raw(text):
-                if webhook:
-                    try:
-                        self.webhook_queue.put_nowait((webhook, text, msg.author.name, msg.author.avatar_url))
-                    except asyncio.QueueFull:
-                        text = f"<{msg.author.name}> {text}"
-                        await channel.send(text[:2000], allowed_mentions=discord.AllowedMentions(everyone=False, roles=False, users=False))
-                else:
-                    text = f"<{msg.author.name}> {text}"
-                    await channel.send(text[:2000], allowed_mentions=discord.AllowedMentions(everyone=False, roles=False, users=False))
-            content = render_formatting(channel, msg.message)[:2000]
-            if channel_id in util.config["bridge_show_src"] and msg.source[0] == "discord":
-                content = f"<#{msg.source[1]}> " + content
-            await send_raw(content)
-            if attachments_text: await send_raw(attachments_text)
+            # coalesce consecutive messages from the same author into one send where they fit
+            run, run_author, run_length = [], None, 0
+            for msg in msgs:
+                content = self.render_bridged(channel, msg)
+                if run and (msg.author != run_author or run_length + len(content) > 2000):
+                    await self.send_bridged(channel, run_author, "\n".join(run), [])
+                    run, run_length = [], 0
+                run.append(content)
+                run_author = msg.author
+                run_length += len(content) + 1
+                if msg.attachments:
+                    await self.send_bridged(channel, run_author, "\n".join(run), msg.attachments)
+                    run, run_length = [], 0
+            if run: await self.send_bridged(channel, run_author, "\n".join(run), [])
         else:
             logging.warning("Channel %d not found", channel_id)
 
@@ -118,30 +331,67 @@ class Telephone(commands.Cog):
         if msg.content == "" and len(msg.attachments) == 0: return
         if (msg.author == self.bot.user and (len(msg.content) > 0 and msg.content[0] == "<")) or msg.author.discriminator == "0000": return
         channel_id = msg.channel.id
+        if not eventbus.find_all_destinations(("discord", channel_id)): return
+        self.index_message(msg.id, channel_id, msg.author.name, False, msg.content)
         reply = None
         if msg.reference:
             if isinstance(msg.reference.resolved, discord.DeletedReferencedMessage):
-                replying_to = None
+                reply = (None, None)
             elif msg.reference.resolved:
-                replying_to = msg.reference.resolved
+                reply = self.reply_info(msg.reference.resolved)
+            elif cached := reply_cache.get(msg.reference.message_id):
+                reply = cached
             elif msg.reference.cached_message:
-                replying_to = msg.reference.cached_message
-            else:
-                try:
-                    replying_to = await self.bot.get_guild(msg.reference.guild_id).get_channel(msg.reference.channel_id).fetch_message(msg.reference.message_id)
-                except (discord.HTTPException, AttributeError):
-                    replying_to = None
-            if replying_to:
-                reply = (eventbus.AuthorInfo(replying_to.author.name, replying_to.author.id, str(replying_to.author.display_avatar.url), replying_to.author.bot), parse_formatting(self.bot, replying_to.content))
+                reply = self.reply_info(msg.reference.cached_message)
             else:
+                # don't hold up delivery for a REST call - deliver without context, and fetch it so later replies have it
                 reply = (None, None)
-        msg = eventbus.Message(eventbus.AuthorInfo(msg.author.name, msg.author.id, str(msg.author.display_avatar.url), msg.author.bot),
-            parse_formatting(self.bot, msg.content), ("discord", channel_id), msg.id, [ at for at in msg.attachments if not at.is_spoiler() ], reply=reply)
+                self.fetch_reply(msg.reference)
+        author = eventbus.AuthorInfo(msg.author.name, msg.author.id, str(msg.author.display_avatar.url), msg.author.bot)
+        content = parse_formatting(self.bot, msg.content)
+        reply_cache[msg.id] = (author, content)
+        msg = eventbus.Message(author, content, ("discord", channel_id), msg.id, [ at for at in msg.attachments if not at.is_spoiler() ], reply=reply)
         await eventbus.push(msg)
 
+    def reply_info(self, replying_to):
+        reply = reply_cache.get(replying_to.id)
+        if reply is None:
+            reply = reply_cache[replying_to.id] = (eventbus.AuthorInfo(replying_to.author.name, replying_to.author.id, str(replying_to.author.display_avatar.url), replying_to.author.bot), parse_formatting(self.bot, replying_to.content))
+        return reply
+
+    def fetch_reply(self, reference):
+        if reference.message_id in self.reply_fetches: return
+        async def fetch():
+            try:
+                self.reply_info(await self.bot.get_guild(reference.guild_id).get_channel(reference.channel_id).fetch_message(reference.message_id))
+            except (discord.HTTPException, AttributeError):
+                pass
+            finally:
+                self.reply_fetches.discard(reference.message_id)
+        self.reply_fetches.add(reference.message_id)
+        asyncio.create_task(fetch())
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        member_cache.pop((member.guild.id, member.id))
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        mention_cache.pop(("@", after.id))
+
+    @commands.Cog.listener("on_guild_channel_update")
+    async def invalidate_channel(self, before, after):
+        mention_cache.pop(("#", after.id))
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        mention_cache.pop(("#", channel.id))
+
     def cog_unload(self):
         self.unlisten()
-        self.webhook_queue_handler_task.cancel()
+        for task in self.webhook_sender_tasks: task.cancel()
+        self.index_task.cancel()
+        asyncio.create_task(self.flush_index())
 
     # ++tel commands
 
@@ -154,12 +404,6 @@ When you want to end a call, use hangup.
 """
         pass
 
-    async def get_channel_config(self, channel):
-        return await self.bot.database.execute_fetchone("SELECT * FROM telephone_config WHERE channel_id = ?", (channel,))
-
-    async def get_addr_config(self, addr):
-        return await self.bot.database.execute_fetchone("SELECT * FROM telephone_config WHERE id = ? COLLATE NOCASE", (addr,))
-
     @telephone.command(brief="Link to other channels", help="""Connect to another channel on Discord or any supported bridges.
     Virtual channels also exist.
     """)
@@ -184,34 +428,58 @@ When you want to end a call, use hangup.
         await ctx.send(f"Successfully deleted.")
         pass
 
-    async def find_recent(self, chs, query):
-        one_week = timedelta(seconds=60*60*24*7)
-        one_week_ago = datetime.now() - one_week
-
-        for ch in chs:
-            yield True, ch
-            async for msg in ch.history(limit=None,after=one_week_ago):
-                if query in msg.content.lower():
-                    yield False, ch, msg
+    @telephone.command(brief="Export all bridge links as JSON.")
+    @commands.check(util.admin_check)
+    async def export_links(self, ctx):
+        rows = await eventbus.export_links(self.bot.database)
+        await ctx.send(f"{len(rows)} links.", file=discord.File(io.BytesIO(util.json_encode(rows).encode("utf-8")), filename="links.json"))
+
+    @telephone.command(brief="Import bridge links from attached JSON.", help="""Import links from a JSON file (in export_links format) attached to the command message, in one transaction.
+    If replace is set, existing links not in the file are removed.""")
+    @commands.check(util.admin_check)
+    async def import_links(self, ctx, replace: bool = False):
+        if not ctx.message.attachments: raise ValueError("No file attached")
+        rows = json.loads(await ctx.message.attachments[0].read())
+        added = [ ((row["from_type"], row["from_id"]), (row["to_type"], row["to_id"]), row.get("cause")) for row in rows ]
+        removed = []
+        if replace:
+            keep = { (c1, c2) for c1, c2, _ in added }
+            removed = [ (c1, c2) for c1, targets in eventbus.links.items() for c2 in targets if (c1, c2) not in keep ]
+        await eventbus.apply_link_changes(self.bot.database, added, removed)
+        await ctx.send(f"Imported {len(added)} links, removed {len(removed)}.")
+
+    async def find_recent(self, channel_ids, query):
+        await self.flush_index()
+        if len(query) >= 3:
+            # a quoted phrase is a substring match under the trigram tokenizer, answered from the index (LIKE ... ESCAPE isn't)
+            condition, param = "f.content MATCH ?", '"' + query.replace('"', '""') + '"'
+        else:
+            # the trigram index can't match fewer than 3 characters, so scan
+            condition, param = "instr(lower(f.content), lower(?)) > 0", query
+        rows = await self.bot.database.execute_fetchall(f"""SELECT m.*, f.content FROM bridged_messages_fts f JOIN bridged_messages m ON m.message_id = f.rowid
+            WHERE {condition} AND m.timestamp > ? AND m.channel_id IN ({", ".join("?" * len(channel_ids))}) ORDER BY m.timestamp""",
+            (param, util.timestamp() - INDEX_RETENTION, *channel_ids))
+        found = collections.defaultdict(list)
+        for row in rows:
+            found[row["channel_id"]].append(row)
+        return found
 
     @telephone.command(brief="Find recent messages in channels linked to this")
     @commands.check(util.extpriv_check)
     async def searchrecent(self, ctx, ch: discord.TextChannel, *, query):
         author = ctx.author
-        chs = []
-        for dest in eventbus.find_all_destinations(("discord",ch.id)):
-            if dest[0] == "discord":
-                chs.append(self.bot.get_channel(dest[1]))
+        channel_ids = [ dest[1] for dest in eventbus.find_all_destinations(("discord", ch.id)) if dest[0] == "discord" ]
 
-        found = await self.find_recent(chs, query)
+        found = await self.find_recent(channel_ids, query)
 
         out = ""
-        async for ch,ms in found.items():
-            out += f"{ch.mention} (`#{ch.name}` in `{ch.guild.name}`)\n"
-            for m in ms:
-                u = m.author.name if m.author else None
-                w = "[WH]" if m.webhook_id else ""
-                out += f"- {m.content[:20]} @{m.created_at} by {u} {w}\n"
+        for channel_id, rows in found.items():
+            channel = self.bot.get_channel(channel_id)
+            out += f"{channel.mention} (`#{channel.name}` in `{channel.guild.name}`)\n" if channel else f"{channel_id}\n"
+            for row in rows:
+                w = "[WH]" if row["webhook"] else ""
+                out += f"- {row['content'][:20]} @{datetime.utcfromtimestamp(row['timestamp'])} by {row['author']} {w}\n"
+        if not out: out = "No messages found."
 
         for c in util.chunks(out,2000):
             await author.send(c)
@@ -223,6 +491,7 @@ When you want to end a call, use hangup.
     async def delrecent(self, ctx, ch: discord.TextChannel, *, query):
         author = ctx.author
         found = await self.searchrecent(ctx,ch,query=query)
+        if not found: return
 
         await author.send("please say 'GO' to confirm or wait 10 seconds to not confirm")
         try:
@@ -231,35 +500,33 @@ When you want to end a call, use hangup.
             await author.send("timed out")
             return
 
-        async def try_delete(msg,session):
-            if msg.webhook_id is not None:
-                # note: assumes there is only one webhook we control per channel
-                # i think that's the case
-                wh_url = await self.bot.database.execute_fetchone("SELECT webhook FROM discord_webhooks WHERE channel_id = ?",(msg.channel.id,))
-                if wh_url is None:
-                    await author.send(f"no access to webhook: {msg.id} {msg.channel.mention} {msg.jump_url}")
-                    return
-                wh_url = wh_url['webhook']
-
-                wh = discord.Webhook.from_url(wh_url,session=session)
-                await wh.delete_message(msg.id)
-
-            else:
+        semaphore = asyncio.Semaphore(DELETE_PARALLELISM)
+        deleted = []
+        async def try_delete(row):
+            message_id, channel_id = row["message_id"], row["channel_id"]
+            async with semaphore:
                 try:
-                    await msg.delete()
-                except discord.errors.Forbidden:
-                    await author.send(f"!!! couldn't delete msg {msg.id} in {msg.channel.mention}")
-
-        msgs = []
-        for q in found.values():
-            msgs.extend(q)
+                    if row["webhook"]:
+                        # note: assumes there is only one webhook we control per channel
+                        # i think that's the case
+                        wh_url = self.webhooks.get(channel_id)
+                        if wh_url is None:
+                            await author.send(f"no access to webhook: {message_id} <#{channel_id}>")
+                            return
+                        await self.get_webhook(wh_url).delete_message(message_id)
+                    else:
+                        await self.bot.get_channel(channel_id).get_partial_message(message_id).delete()
+                    deleted.append(message_id)
+                except discord.NotFound:
+                    deleted.append(message_id)
+                except (discord.HTTPException, AttributeError):
+                    await author.send(f"!!! couldn't delete msg {message_id} in <#{channel_id}>")
 
-        async with aiohttp.ClientSession() as session:
-            await asyncio.gather(*(try_delete(msg,session) for msg in msgs))
+        await asyncio.gather(*(try_delete(row) for rows in found.values() for row in rows))
+        await self.forget_messages(deleted)
 
         await author.send("done")
 
-
     @telephone.command(brief="Generate a webhook")
     @commands.check(util.server_mod_check)
     async def init_webhook(self, ctx):
@@ -272,9 +539,9 @@ When you want to end a call, use hangup.
     @telephone.command()
     @commands.check(util.server_mod_check)
     async def setup(self, ctx):
-        num = generate_address(ctx)
+        num = generate_address(ctx.guild.id, lambda address: self.directory.address_taken(address, ctx.guild.id))
         await ctx.send(f"Your address is {num}.")
-        info = await self.get_addr_config(num)
+        info = self.directory.get_address(num)
         webhook = None
         if info: webhook = info["webhook"]
         if not info or not webhook:
@@ -285,33 +552,35 @@ When you want to end a call, use hangup.
             except discord.Forbidden as f:
                 logging.warn("Could not create webhook in #%s %s", ctx.channel.name, ctx.guild.name, exc_info=f)
                 await ctx.send("Webhook creation failed - please ensure permissions are available. This is not necessary but is recommended.")
-        await self.bot.database.execute("INSERT OR REPLACE INTO telephone_config VALUES (?, ?, ?, ?, 0)", (num, ctx.guild.id, ctx.channel.id, webhook))
-        await self.bot.database.commit()
+        await self.directory.configure(num, ctx.guild.id, ctx.channel.id, webhook)
+        await self.directory.commit()
         await ctx.send("Configured.")
 
     @telephone.command(aliases=["rcall"], brief="Dial another telephone channel.")
     async def rdial(self, ctx):
-        # TODO: this is not very performant
-        random = (await self.bot.database.execute_fetchone("SELECT id FROM telephone_config WHERE disabled = 0 ORDER BY RANDOM()"))["id"]
-        await self.dial(ctx, random)
+        address = self.directory.random_enabled()
+        if not address: return await ctx.send(embed=util.error_embed("No telephone channels are available."))
+        await self.dial(ctx, address)
 
     @telephone.command(aliases=["call"], brief="Dial another telephone channel.")
     async def dial(self, ctx, address):
         # basic checks - ensure this is a phone channel and has no other open calls
-        channel_info = await self.get_channel_config(ctx.channel.id)
+        channel_info = self.directory.get_channel(ctx.channel.id)
         if not channel_info: return await ctx.send(embed=util.error_embed("Not in a phone channel."))
         originating_address = channel_info["id"]
-        if address == originating_address: return await ctx.send(embed=util.error_embed("A channel cannot dial itself. That means *you*, Gibson."))
-        recv_info = await self.get_addr_config(address)
+        recv_info = self.directory.get_address(address)
         if not recv_info: return await ctx.send(embed=util.error_embed("Destination address not found. Please check for typos and/or antimemes."))
+        address = recv_info["id"]
+        if address == originating_address: return await ctx.send(embed=util.error_embed("A channel cannot dial itself. That means *you*, Gibson."))
 
-        current_call = await self.bot.database.execute_fetchone("SELECT * FROM calls WHERE from_id = ?", (originating_address,))
+        current_call = self.directory.outgoing(originating_address)
         if current_call: return await ctx.send(embed=util.error_embed(f"A call is already open (to {current_call['to_id']}) from this channel. Currently, only one outgoing call is permitted at a time."))
 
         # post embed in the receiving channel prompting people to accept/decline call
         recv_channel = self.bot.get_channel(recv_info["channel_id"])
         if recv_channel is None:
-            await self.bot.database.execute("UPDATE telephone_config SET disabled = 1 WHERE id = ?", (address,))
+            await self.directory.disable(address)
+            await self.directory.commit()
             return await ctx.send(embed=util.error_embed("Target channel no longer exists."))
         _, call_message = await asyncio.gather(
             ctx.send(embed=util.info_embed("Outgoing call", f"Dialing {address}...")),
@@ -339,8 +608,8 @@ When you want to end a call, use hangup.
         await asyncio.gather(call_message.remove_reaction("✅", self.bot.user), call_message.remove_reaction("❎", self.bot.user))
         em = str(reaction.emoji) if reaction else "❎"
         if em == "✅": # accept call
-            await self.bot.database.execute("INSERT INTO calls VALUES (?, ?, ?)", (originating_address, address, util.timestamp()))
-            await self.bot.database.commit()
+            await self.directory.add_call(originating_address, address, util.timestamp())
+            await self.directory.commit()
             await eventbus.add_bridge_link(self.bot.database, ("discord", ctx.channel.id), ("discord", recv_channel.id), "telephone")
             await asyncio.gather(
                 ctx.send(embed=util.info_embed("Outgoing call", "Call accepted and connected.")),
@@ -351,22 +620,22 @@ When you want to end a call, use hangup.
 
     @telephone.command(aliases=["disconnect", "quit"], brief="Disconnect latest call.")
     async def hangup(self, ctx):
-        channel_info = await self.get_channel_config(ctx.channel.id)
-        addr = channel_info["id"]
+        channel_info = self.directory.get_channel(ctx.channel.id)
         if not channel_info: return await ctx.send(embed=util.error_embed("Not in a phone channel."))
-        from_here = await self.bot.database.execute_fetchone("SELECT * FROM calls WHERE from_id = ?", (addr,))
-        to_here = await self.bot.database.execute_fetchone("SELECT * FROM calls WHERE to_id = ?", (addr,))
+        addr = channel_info["id"]
+        from_here = self.directory.outgoing(addr)
+        to_here = next(iter(self.directory.incoming(addr)), None)
         if (not to_here) and (not from_here): return await ctx.send(embed=util.error_embed("No calls are active."))
 
         other = None
         if from_here:
             other = from_here["to_id"]
-            await self.bot.database.execute("DELETE FROM calls WHERE from_id = ? AND to_id = ?", (addr, other))
+            await self.directory.remove_call(addr, other)
         elif to_here:
             other = to_here["from_id"]
-            await self.bot.database.execute("DELETE FROM calls WHERE to_id = ? AND from_id = ?", (addr, other))
-        await self.bot.database.commit()
-        other_channel = (await self.get_addr_config(other))["channel_id"]
+            await self.directory.remove_call(other, addr)
+        await self.directory.commit()
+        other_channel = self.directory.get_address(other)["channel_id"]
         await eventbus.remove_bridge_link(self.bot.database, ("discord", other_channel), ("discord", ctx.channel.id))
 
         await asyncio.gather(
@@ -376,7 +645,7 @@ When you want to end a call, use hangup.
 
     @telephone.command(aliases=["status"], brief="List inbound/outbound calls.")
     async def info(self, ctx):
-        channel_info = await self.get_channel_config(ctx.channel.id)
+        channel_info = self.directory.get_channel(ctx.channel.id)
         if not channel_info: return await ctx.send(embed=util.info_embed("Phone status", "Not a phone channel"))
         addr = channel_info['id']
         title = f"{addr} status"
@@ -387,49 +656,63 @@ When you want to end a call, use hangup.
         def delta(ts):
             return util.format_timedelta(datetime.utcfromtimestamp(ts), now)
 
-        incoming = await self.bot.database.execute_fetchall("SELECT * FROM calls WHERE to_id = ?", (addr,))
+        incoming = self.directory.incoming(addr)
         fields.extend(map(lambda x: ["Incoming call", f"From {x['from_id']} - for {delta(x['start_time'])}"], incoming))
-        outgoing = await self.bot.database.execute_fetchall("SELECT * FROM calls WHERE from_id = ?", (addr,))
+        outgoing = [ call ] if (call := self.directory.outgoing(addr)) else []
         fields.extend(map(lambda x: ["Outgoing call", f"To {x['to_id']} - for {delta(x['start_time'])}"], outgoing))
         await ctx.send(embed=util.info_embed(title, f"Connected: {len(incoming) + len(outgoing)}", fields))
 
     @telephone.command(brief="Dump links out of current channel.")
     async def graph(self, ctx):
-        graph = pydot.Dot("linkgraph", ratio="fill", overlap="false")
-        seen = set()
-        seen_edges = set()
+        names = {}
         def node_name(x):
+            if x in names: return names[x]
+            name = f"{x[0]}/{x[1]}"
             if x[0] == "discord":
                 chan = self.bot.get_channel(x[1])
                 if chan and getattr(chan, "name", False):
                     out = "#" + chan.name
                     if chan.guild:
                         out = chan.guild.name + "/" + out
-                    return "discord/" + out
-                else:
-                    return f"{x[0]}/{x[1]}"
-            return f"{x[0]}/{x[1]}"
-        todo = [("discord", ctx.channel.id)]
-
+                    name = "discord/" + out
+            names[x] = name
+            return name
+
+        start = ("discord", ctx.channel.id)
+        seen = {start}
+        todo = collections.deque(seen)
+        edges = []
         while todo:
-            current = todo.pop(0)
-            graph.add_node(pydot.Node(node_name(current), fontname="monospace"))
+            current = todo.popleft()
+            node_name(current)
             for adjacent in eventbus.links[current]:
                 if adjacent not in seen:
+                    seen.add(adjacent)
                     todo.append(adjacent)
-                edge = (current, adjacent)
-                if edge not in seen_edges:
-                    graph.add_edge(pydot.Edge(node_name(current), node_name(adjacent)))
-                    seen_edges.add(edge)
-            seen.add(current)
-        (handle, tmppath) = tempfile.mkstemp(".png", "graphviz")
-        graph.write_png(tmppath, prog="neato")
-        try:
-            await ctx.send(file=discord.File(handle, filename="out.png"))
-        finally:
-            os.unlink(tmppath)
+                edges.append((node_name(current), node_name(adjacent)))
+
+        # the cache key covers everything drawn, so link changes (or renames) just produce a different key
+        nodes, edges = sorted(names.values()), sorted(edges)
+        key = hashlib.blake2b(repr((nodes, edges)).encode("utf-8")).digest()
+        png = graph_cache.get(key)
+        if png is None:
+            png = graph_cache[key] = await asyncio.to_thread(render_graph, nodes, edges)
+        await ctx.send(file=discord.File(io.BytesIO(png), filename="out.png"))
+
+# graphviz layout is slow, so results are kept; it runs in a neato subprocess, which a thread can wait on without holding up the event loop
+# (a process pool would fork the bot, threads and all, which can deadlock the children)
+graph_cache = util.LRUCache(64)
+
+def render_graph(nodes, edges):
+    graph = pydot.Dot("linkgraph", ratio="fill", overlap="false")
+    for node in nodes:
+        graph.add_node(pydot.Node(node, fontname="monospace"))
+    for a, b in edges:
+        graph.add_edge(pydot.Edge(a, b))
+    return graph.create_png(prog="neato")
 
 async def setup(bot):
     cog = Telephone(bot)
+    await cog.directory.load()
     await bot.add_cog(cog)
     asyncio.create_task(cog.initial_load_webhooks())
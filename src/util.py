@@ -88,44 +88,109 @@ def rpartfor(u):
 
 short_timedelta_regex = re.compile("\n".join(map(rpartfor, time_units)), re.VERBOSE)
 
+class LRUCache:
+    "Mapping holding at most max_size entries, discarding the least recently used ones first."
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            self.entries.move_to_end(key)
+        except KeyError:
+            return default
+        return self.entries[key]
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __contains__(self, key): return key in self.entries
+    def __len__(self): return len(self.entries)
+    def pop(self, key, default=None): return self.entries.pop(key, default)
+    def clear(self): self.entries.clear()
+
+number_regex = re.compile(number)
 def parse_prefixed(s):
-    match = re.match(number, s)
+    match = number_regex.match(s)
     if not match: raise ValueError("does not match metric-prefixed integer format - ensure prefix is valid")
     num = float(match.group(1))
     prefix = match.group(2)
     if prefix: num *= (10 ** prefixes[prefix])
     return num
 
-def parse_short_timedelta(text):
+# units relativedelta accepts directly
+delta_units = ("years", "months", "weeks", "days", "hours", "minutes", "seconds")
+
+def short_timedelta(text):
+    "Parse a short timedelta spec into a relativedelta, and whether the result is deterministic (random units aren't)."
     match = short_timedelta_regex.fullmatch(text)
     if match is None or not match.group(0): raise ValueError("parse failed")
-    data = { k: parse_prefixed(v) if v else 0 for k, v in match.groupdict().items() }
-    for tu, mapping in tu_mappings.items():
-        if callable(mapping): mapping = mapping()
-        qty, resunit = mapping
-        data[resunit] += qty * data[tu]
-        del data[tu]
+    data = dict.fromkeys(delta_units, 0)
+    deterministic = True
+    for tu, value in match.groupdict().items():
+        if not value: continue
+        qty = parse_prefixed(value)
+        mapping = tu_mappings.get(tu)
+        if mapping is None:
+            data[tu] += qty
+            continue
+        if callable(mapping):
+            mapping = mapping()
+            deterministic = False
+        factor, resunit = mapping
+        data[resunit] += factor * qty
     for tu, (qty, unit) in fractional_tu_mappings.items():
-        if tu in data and math.floor(data[tu]) != data[tu]:
+        if math.floor(data[tu]) != data[tu]:
             whole = math.floor(data[tu])
-            fractional = data[tu] - whole
+            data[unit] += (data[tu] - whole) * qty
             data[tu] = whole
-            data[unit] += fractional * qty
-    return datetime.datetime.now(tz=datetime.timezone.utc) + relativedelta(**data)
+    return relativedelta(**data), deterministic
+
+# spec -> relativedelta, or None for specs which don't parse; these don't depend on the current time or timezone, so are safe to reuse
+short_timedelta_cache = LRUCache(4096)
+def cached_short_timedelta(text):
+    delta = short_timedelta_cache.get(text, False)
+    if delta is False:
+        try:
+            delta, deterministic = short_timedelta(text)
+        except ValueError:
+            short_timedelta_cache[text] = None
+            raise
+        if deterministic: short_timedelta_cache[text] = delta
+    if delta is None: raise ValueError("parse failed")
+    return delta
+
+def parse_short_timedelta(text):
+    return datetime.datetime.now(tz=datetime.timezone.utc) + cached_short_timedelta(text)
 
 cal = parsedatetime.Calendar()
 def parse_humantime(text, tz):
-    dt_tuple = cal.parseDT(text, tzinfo=tz)
-    if dt_tuple: return dt_tuple[0]
+    dt, status = cal.parseDT(text, tzinfo=tz)
+    # status 0 means nothing was recognized, and dt is just the current time
+    if status: return dt
     else: raise ValueError("parse failed")
 
+DATE_REGEX = re.compile("[0-9]{4}-[0-9]{1,2}-[0-9]{1,2}")
+date_cache = LRUCache(1024)
+def parse_date(text):
+    date = date_cache.get(text)
+    if date is None:
+        date = date_cache[text] = datetime.datetime.strptime(text, "%Y-%m-%d")
+    return date
+
 def parse_time(text, tz):
-    try: return datetime.datetime.strptime(text, "%Y-%m-%d")
-    except: pass
-    try: return parse_short_timedelta(text)
-    except: pass
+    # pick plausible formats by their first characters rather than trying every parser in turn
+    if DATE_REGEX.fullmatch(text):
+        try: return parse_date(text)
+        except ValueError: pass
+    if text[:1] in "-0123456789\t\n\r ":
+        try: return parse_short_timedelta(text)
+        except (ValueError, OverflowError): pass
     try: return parse_humantime(text, tz)
-    except: pass
+    except (ValueError, OverflowError): pass
     raise ValueError("time matches no available format")
 
 def format_time(dt):